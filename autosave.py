@@ -0,0 +1,217 @@
+"""
+Saving the city in the background after every turn.
+At the end of CityEngine.start_turn the autosaver takes a snapshot of the
+city, which is all the game loop pays for, and a worker thread writes it to
+disk, replacing the previous autosave atomically.
+The snapshot is copy-on-write rather than a copy: the worker keeps its own
+copy of the field arrays, and a snapshot only carries the cells that changed
+since the last one, as reported by the CellField. Likewise, the records of
+buildings are only made again for buildings the scheduler has rescheduled
+since, as nothing else changes a building's state, and they are kept in
+chunks that are only copied when a building in them changes. Buildings
+aren't settled either; their records are brought up to date with the
+snapshot's turn by the worker (see Building.saved_state). So a snapshot
+costs about as much as the turn has changed, not as much as the city is
+large.
+If the previous save is still being written, the turn isn't saved at all.
+"""
+
+import queue
+import threading
+from array import array
+from itertools import chain
+from time import perf_counter
+
+import saves
+
+#  Building states per chunk
+chunk_size = 1024
+
+
+def settled_record(state, turn):
+    """
+    Return a save record for a cached building state, settled to `turn`
+    :param state: (class name, name, image source, acceptable ground, cell
+    number, values, turn of values, changes a turn)
+    :param turn:
+    :return:
+    """
+    *record, values, synced_turn, changes = state
+    if changes is not None:
+        values = tuple(value + (turn - synced_turn)*change
+                       for value, change in zip(values, changes))
+    record.append(values)
+    return tuple(record)
+
+
+class Autosaver:
+    """
+    Saves a CityEngine to `path` every `interval` turns.
+    Attach it with `engine.autosaver = Autosaver(path)`, and close it when
+    the game is over
+    """
+    def __init__(self, path, interval=1):
+        self.path = path
+        self.interval = interval
+        #  The CellField and TurnScheduler whose changes are tracked
+        self.cell_field = None
+        self.scheduler = None
+        #  Building states by building_id, see settled_record, in chunks of
+        #  chunk_size. The list of chunks is copied into every snapshot, so
+        #  chunks are shared with the worker unless they are in `owned`
+        self.chunks = []
+        self.owned = set()
+        self.state_count = 0
+        #  The worker's copy of the field arrays: grounds, bonuses, built
+        #  and building_ids
+        self.arrays = None
+        self.jobs = queue.Queue()
+        #  Set while no snapshot is being written
+        self.idle = threading.Event()
+        self.idle.set()
+        self.saved = 0
+        self.skipped = 0
+        #  Time the last snapshot took on the game thread, in seconds
+        self.snapshot_time = 0.0
+        #  The exception the last failed save raised, if any
+        self.error = None
+        self.worker = threading.Thread(target=self.work, name='autosave',
+                                       daemon=True)
+        self.worker.start()
+
+    def turn_started(self, engine):
+        """
+        Save the engine unless it's not the turn for it or the previous save
+        is not written yet. Called by the engine at the end of start_turn
+        :param engine:
+        :return:
+        """
+        if engine.turn % self.interval:
+            return
+        if not self.idle.is_set():
+            self.skipped += 1
+            return
+        start = perf_counter()
+        job = self.take_snapshot(engine)
+        self.idle.clear()
+        self.jobs.put(job)
+        self.snapshot_time = perf_counter() - start
+
+    def take_snapshot(self, engine):
+        """
+        Return what the worker needs to save the engine: a CitySnapshot
+        without field arrays and with chunks of cached building states for
+        records, a list of (cell number, ground, bonus, built, building_id)
+        for the cells changed since the last snapshot, and new field arrays
+        for the worker if it has to start over (eg for the first snapshot) or
+        None
+        :param engine:
+        :return: (snapshot, changed cells, field arrays or None)
+        """
+        cell_field = engine.cell_field
+        scheduler = engine.scheduler
+        arrays = None
+        if cell_field is not self.cell_field or \
+                scheduler is not self.scheduler:
+            #  A new city, or the first save
+            self.cell_field = cell_field
+            self.scheduler = scheduler
+            cell_field.changed = set()
+            scheduler.changed = set()
+            self.chunks = []
+            self.owned = set()
+            self.state_count = 0
+            arrays = (bytearray(cell_field.grounds),
+                      bytearray(cell_field.bonuses),
+                      bytearray(cell_field.built),
+                      array('i', cell_field.building_ids))
+        cells = [(x, cell_field.grounds[x], cell_field.bonuses[x],
+                  cell_field.built[x], cell_field.building_ids[x])
+                 for x in cell_field.changed]
+        cell_field.changed.clear()
+        buildings = cell_field.buildings
+        for building_id in scheduler.changed:
+            if building_id < self.state_count:
+                self.set_state(building_id, buildings[building_id])
+        scheduler.changed.clear()
+        for building_id in range(self.state_count, len(buildings)):
+            self.set_state(building_id, buildings[building_id])
+        self.owned.clear()
+        snapshot = saves.take_snapshot(engine, buildings=list(self.chunks),
+                                       cells=False)
+        return snapshot, cells, arrays
+
+    def set_state(self, building_id, building):
+        """
+        Record the state of a building, copying its chunk first if it's
+        shared with the worker
+        :param building_id:
+        :param building:
+        :return:
+        """
+        index, offset = divmod(building_id, chunk_size)
+        if index == len(self.chunks):
+            self.chunks.append([])
+            self.owned.add(index)
+        elif index not in self.owned:
+            self.chunks[index] = list(self.chunks[index])
+            self.owned.add(index)
+        chunk = self.chunks[index]
+        state = self.building_state(building)
+        if offset == len(chunk):
+            chunk.append(state)
+            self.state_count += 1
+        else:
+            chunk[offset] = state
+
+    @staticmethod
+    def building_state(building):
+        values, synced_turn, changes = building.saved_state()
+        return (type(building).__name__, building.name,
+                building.image_source, tuple(building.acceptable_ground),
+                building.number, values, synced_turn, changes)
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            try:
+                self.write(*job)
+                self.saved += 1
+            except Exception as e:
+                #  A failed save mustn't stop the ones after it
+                self.error = e
+            finally:
+                self.idle.set()
+
+    def write(self, snapshot, cells, arrays):
+        """
+        Complete a snapshot and write it. Runs on the worker thread
+        :param snapshot:
+        :param cells:
+        :param arrays:
+        :return:
+        """
+        if arrays is not None:
+            self.arrays = arrays
+        grounds, bonuses, built, building_ids = self.arrays
+        for number, ground, bonus, is_built, building_id in cells:
+            grounds[number] = ground
+            bonuses[number] = bonus
+            built[number] = is_built
+            building_ids[number] = building_id
+        snapshot = snapshot._replace(
+            grounds=bytes(grounds), bonuses=bytes(bonuses),
+            built=bytes(built), building_ids=saves.array_bytes(building_ids),
+            buildings=[settled_record(x, snapshot.turn)
+                       for x in chain.from_iterable(snapshot.buildings)])
+        saves.replace_file(snapshot, self.path)
+
+    def close(self):
+        """
+        Finish writing the last save and stop the worker
+        :return:
+        """
+        self.jobs.put(None)
+        self.worker.join()
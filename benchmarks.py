@@ -0,0 +1,325 @@
+"""
+Benchmarks of the engine's hot paths.
+Every benchmark is run for every field size, and the best time of a few
+repeats is reported per call, in microseconds. Benchmarks that change the
+city they run on, like the ones advancing turns, start every call from a
+freshly built city, so that they don't end up timing a city where nothing
+happens any more. Results are written as JSON, in seconds, and may be
+compared against a baseline file (a result file from an earlier run, on the
+same machine) to catch regressions.
+
+Example:
+    python benchmarks.py --output baseline.json
+    ...
+    python benchmarks.py --baseline baseline.json --tolerance 0.25
+
+The exit status is 1 if anything got slower than the baseline by more than
+the tolerance.
+"""
+
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import timeit
+
+from autosave import Autosaver
+from cells import CellField, ground_type_list
+from city import CityState
+from engine import CityEngine
+from tiles import TileResolver
+
+default_sizes = (18, 64, 256, 1024)
+
+#  Per-cell benchmarks sample this many cells, so that large fields take
+#  reasonable time. Their results are still per call, not per cell
+sample_size = 10000
+
+#  How many turns `advance` steps through, one at a time
+turn_count = 50
+
+#  Benchmark name: function of field size returning a callable to be timed,
+#  or a (setup, run) pair, see measure_fresh
+benchmarks = {}
+
+
+def benchmark(function):
+    """
+    Register a benchmark. The function does the setup and returns a callable,
+    or, if calling it changes what it runs on, a function returning a fresh
+    state and a callable taking that state
+    :param function:
+    :return:
+    """
+    benchmarks[function.__name__] = function
+    return function
+
+
+def random_field(size, seed=0):
+    """
+    Return a CellField with random grounds
+    :param size:
+    :param seed:
+    :return:
+    """
+    rng = random.Random(seed)
+    cell_field = CellField(size)
+    cell_field.connect_citystate(CityState())
+    cell_field.populate()
+    for number in range(size*size):
+        cell_field.set_ground(number, rng.choice(ground_type_list))
+    return cell_field
+
+
+def sample_cells(size, seed=0):
+    rng = random.Random(seed)
+    return [rng.randrange(size*size) for x in range(sample_size)]
+
+
+def built_engine(size, seed=0):
+    """
+    Return an engine with every building type placed on a quarter of cells
+    :param size:
+    :param seed:
+    :return:
+    """
+    rng = random.Random(seed)
+    engine = CityEngine(field_size=size, seed=seed)
+    factory = engine.next_item_factory
+    makers = (('house', 'living'),
+              ('boat', 'water'),
+              ('smithery', 'military'))
+    engine.city_state.resources['workforce'] = size*size
+    for number in range(0, size*size, 4):
+        item, ground_type = rng.choice(makers)
+        engine.cell_field.set_ground(number, ground_type)
+        engine.place_item(factory.create_building(item), number)
+    return engine
+
+
+@benchmark
+def populate(size):
+    def run():
+        cell_field = CellField(size)
+        cell_field.connect_citystate(CityState())
+        cell_field.populate()
+    return run
+
+
+@benchmark
+def get_neighbours(size):
+    cell_field = random_field(size)
+    numbers = sample_cells(size)
+
+    def run():
+        for number in numbers:
+            cell_field.get_neighbours(number)
+    return run
+
+
+@benchmark
+def make_turn(size):
+    def run(engine):
+        for building in engine.buildings:
+            building.make_turn()
+    return lambda: built_engine(size), run
+
+
+@benchmark
+def advance(size):
+    def run(engine):
+        scheduler = engine.scheduler
+        for x in range(turn_count):
+            scheduler.advance(1)
+    return lambda: built_engine(size), run
+
+
+@benchmark
+def fast_forward(size):
+    def run(engine):
+        engine.fast_forward(1000)
+    return lambda: built_engine(size), run
+
+
+@benchmark
+def tile_keys(size):
+    cell_field = random_field(size)
+    numbers = sample_cells(size)
+    resolver = TileResolver(cell_field)
+
+    def run():
+        resolver.mark_dirty(numbers)
+        resolver.resolve()
+    return run
+
+
+@benchmark
+def create_item(size):
+    engine = CityEngine(field_size=size, seed=0)
+    factory = engine.next_item_factory
+
+    def run():
+        for x in range(1000):
+            factory.create_item()
+    return run
+
+
+@benchmark
+def can_place(size):
+    engine = CityEngine(field_size=size, seed=0)
+    engine.cell_field.grounds[:] = random_field(size).grounds
+    items = [engine.next_item_factory.create_item() for x in range(10)]
+    numbers = sample_cells(size)
+
+    def run():
+        for item in items:
+            for number in numbers[:1000]:
+                engine.can_place(item, number)
+    return run
+
+
+@benchmark
+def legal_placements(size):
+    engine = CityEngine(field_size=size, seed=0)
+    engine.cell_field.grounds[:] = random_field(size).grounds
+    items = [engine.next_item_factory.create_item() for x in range(10)]
+
+    def run():
+        for item in items:
+            engine.legal_placements(item)
+    return run
+
+
+@benchmark
+def autosave_snapshot(size):
+    def setup():
+        engine = built_engine(size)
+        #  Only the part paid for on the game thread; nothing is written
+        autosaver = Autosaver('autosave.benchmark')
+        autosaver.close()
+        autosaver.take_snapshot(engine)
+        #  The first turn changes most buildings
+        engine.scheduler.advance(1)
+        return engine, autosaver
+
+    def run(state):
+        engine, autosaver = state
+        autosaver.take_snapshot(engine)
+    return setup, run
+
+
+def measure(function, repeat=3, min_time=0.2):
+    """
+    Return the best time of a single call of `function`, in seconds
+    :param function:
+    :param repeat:
+    :param min_time: each repeat calls the function enough times to take
+    at least this long
+    :return:
+    """
+    if isinstance(function, tuple):
+        return measure_fresh(*function, repeat=repeat, min_time=min_time)
+    timer = timeit.Timer(function)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number*min_time/max(elapsed, 1e-9)))
+    return min(timer.repeat(repeat=repeat, number=number))/number
+
+
+def measure_fresh(setup, function, repeat=3, min_time=0.2):
+    """
+    Return the best time of `function(state)` in seconds, calling it once
+    for every state returned by `setup()`. Only the call is timed
+    :param setup:
+    :param function:
+    :param repeat: at least this many calls are made
+    :param min_time: and more, until they took this long with their setup
+    :return:
+    """
+    r = []
+    start = timeit.default_timer()
+    while len(r) < repeat or timeit.default_timer() - start < min_time:
+        state = setup()
+        #  Like timeit, without the garbage collector
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            call_start = timeit.default_timer()
+            function(state)
+            r.append(timeit.default_timer() - call_start)
+        finally:
+            if gc_enabled:
+                gc.enable()
+    return min(r)
+
+
+def run_benchmarks(names, sizes, repeat=3):
+    """
+    Run benchmarks
+    :param names:
+    :param sizes:
+    :param repeat:
+    :return: a dict of {'name[size]': seconds per call}
+    """
+    r = {}
+    for name in names:
+        for size in sizes:
+            key = '{}[{}]'.format(name, size)
+            r[key] = measure(benchmarks[name](size), repeat=repeat)
+            print('{:<28} {:>14.3f} us'.format(key, r[key]*1e6),
+                  file=sys.stderr)
+    return r
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return a list of (key, baseline time, new time) for every benchmark that
+    got slower than the baseline by more than `tolerance` (a fraction)
+    :param results:
+    :param baseline:
+    :param tolerance:
+    :return:
+    """
+    r = []
+    for key, seconds in results.items():
+        old = baseline.get(key)
+        if old is not None and seconds > old*(1 + tolerance):
+            r.append((key, old, seconds))
+    return r
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark StackCity')
+    parser.add_argument('--sizes', default=','.join(map(str, default_sizes)),
+                        help='comma-separated field sizes')
+    parser.add_argument('--only', action='append', choices=sorted(benchmarks),
+                        help='run only this benchmark, may be repeated')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='compare with this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown, as a fraction')
+    args = parser.parse_args(argv)
+    sizes = [int(x) for x in args.sizes.split(',')]
+    results = run_benchmarks(args.only or list(benchmarks), sizes,
+                             repeat=args.repeat)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'results': results}, file, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for key, old, new in regressions:
+            print('{}: {:.3f} us -> {:.3f} us ({:+.0%})'.format(
+                key, old*1e6, new*1e6, new/old - 1))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
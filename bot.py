@@ -0,0 +1,195 @@
+"""
+An automated player.
+For every item it considers a number of legal placements (and a reroll) and
+estimates each of them by Monte Carlo rollouts: the city is copied, the move
+is made and the game goes on for a few turns with random legal moves and
+random future items. The move with the best average score wins.
+Rollouts run in a process pool, each getting a save of the city (see
+saves.py), and a move takes no longer than a given time budget.
+"""
+
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import saves
+
+#  How much each resource is worth when scoring a city
+resource_weights = {'gold': 1.0, 'food': 0.5, 'workforce': 2.0}
+
+PLACE = 'place'
+REROLL = 'reroll'
+
+
+def score(engine):
+    """
+    Return the score of a city
+    :param engine:
+    :return:
+    """
+    resources = engine.city_state.resources
+    return sum(weight*resources[name]
+               for name, weight in resource_weights.items())
+
+
+def play_randomly(engine, turns, rng):
+    """
+    Make `turns` random legal moves, rerolling items that fit nowhere
+    :param engine:
+    :param turns:
+    :param rng:
+    :return:
+    """
+    for x in range(turns):
+        legal = engine.legal_placements()
+        if legal:
+            engine.play(rng.choice(legal))
+        else:
+            engine.reroll()
+
+
+def rollout(save_data, move, depth, seed):
+    """
+    Load a city, make a move, play `depth` random turns and return the score.
+    Runs in a worker process
+    :param save_data:
+    :param move: (PLACE, cell number) or (REROLL, None)
+    :param depth:
+    :param seed:
+    :return:
+    """
+    engine = saves.loads(save_data)
+    rng = random.Random(seed)
+    #  The factory's RNG is a part of the save, so without reseeding the
+    #  rollout would know the actual future items
+    engine.next_item_factory.random.seed(rng.random())
+    if move[0] == PLACE:
+        engine.play(move[1])
+    else:
+        engine.reroll()
+    play_randomly(engine, depth, rng)
+    return score(engine)
+
+
+class MonteCarloBot:
+    """
+    A bot that picks moves by Monte Carlo rollouts.
+    With `processes` = 0 rollouts run in the calling process, which is slower
+    but doesn't need a pool
+    """
+    def __init__(self, time_budget=1.0, depth=20, max_candidates=32,
+                 processes=None, seed=None):
+        #  Seconds per move
+        self.time_budget = time_budget
+        #  Turns per rollout
+        self.depth = depth
+        #  Legal placements are sampled down to this many
+        self.max_candidates = max_candidates
+        self.processes = os.cpu_count() if processes is None else processes
+        self.random = random.Random(seed)
+        self.pool = None
+
+    def candidates(self, engine):
+        """
+        Return a list of moves worth considering
+        :param engine:
+        :return:
+        """
+        legal = engine.legal_placements()
+        if len(legal) > self.max_candidates:
+            legal = self.random.sample(legal, self.max_candidates)
+        return [(PLACE, x) for x in legal] + [(REROLL, None)]
+
+    def choose_move(self, engine):
+        """
+        Return the best move for the engine's next item
+        :param engine:
+        :return: (PLACE, cell number) or (REROLL, None)
+        """
+        moves = self.candidates(engine)
+        if len(moves) == 1:
+            return moves[0]
+        return self.best_move(saves.dumps(engine), moves)
+
+    def best_move(self, save_data, moves):
+        """
+        Return the best of the moves for a saved city. It only needs the
+        save, so it can run while the city itself goes on, eg on a thread
+        :param save_data: city as returned by saves.dumps
+        :param moves: candidate moves, see `candidates`
+        :return: (PLACE, cell number) or (REROLL, None)
+        """
+        if len(moves) == 1:
+            return moves[0]
+        totals = [0.0]*len(moves)
+        counts = [0]*len(moves)
+        deadline = time.monotonic() + self.time_budget
+        if self.processes:
+            self.run_in_pool(save_data, moves, totals, counts, deadline)
+        else:
+            self.run_in_process(save_data, moves, totals, counts, deadline)
+        best = max((x for x in range(len(moves)) if counts[x]),
+                   key=lambda x: totals[x]/counts[x], default=len(moves)-1)
+        return moves[best]
+
+    def run_in_process(self, save_data, moves, totals, counts, deadline):
+        #  At least one round of rollouts, however short the budget is
+        while True:
+            for index, move in enumerate(moves):
+                totals[index] += rollout(save_data, move, self.depth,
+                                         self.random.random())
+                counts[index] += 1
+                if time.monotonic() >= deadline:
+                    return
+
+    def run_in_pool(self, save_data, moves, totals, counts, deadline):
+        if self.pool is None:
+            #  Forking a process that runs other threads, like a UI, may
+            #  copy locks held by them, so workers start from scratch
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context('spawn'))
+        pending = {}
+        next_move = 0
+        while True:
+            #  Keeping every worker busy, with a task queued up for each
+            while time.monotonic() < deadline and \
+                    len(pending) < self.processes*2:
+                future = self.pool.submit(rollout, save_data,
+                                          moves[next_move], self.depth,
+                                          self.random.random())
+                pending[future] = next_move
+                next_move = (next_move + 1) % len(moves)
+            if not pending:
+                return
+            done, not_done = wait(pending,
+                                  timeout=max(0, deadline - time.monotonic()),
+                                  return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                totals[index] += future.result()
+                counts[index] += 1
+            if time.monotonic() >= deadline:
+                for future in pending:
+                    future.cancel()
+                return
+
+    def play_move(self, engine):
+        """
+        Choose a move and make it
+        :param engine:
+        :return: the move made
+        """
+        move = self.choose_move(engine)
+        if move[0] == PLACE:
+            engine.play(move[1])
+        else:
+            engine.reroll()
+        return move
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
@@ -0,0 +1,106 @@
+#! /usr/bin/python3
+"""
+Pack all the sprites into a single atlas, sprites.atlas and sprites-0.png.
+Ground tiles are cut out of grounds.atlas, and every other image (buildings,
+resource icons) is added under its file name without extension, eg 'House'.
+The output uses Kivy's atlas format, so kivy.atlas.Atlas can read it.
+Needs Pillow, like Kivy's own atlas tool. Run it whenever sprites change:
+    python build_atlas.py
+"""
+
+import argparse
+import json
+import os
+
+from PIL import Image
+
+base_path = os.path.dirname(os.path.abspath(__file__))
+sprite_files = ('House.png', 'Boat.png', 'Workshop.png', 'Barrack.png',
+                'Coins.png', 'Food.png', 'Worker.png')
+#  Transparent pixels between regions, so that filtering doesn't bleed
+padding = 2
+
+
+def load_atlas_regions(path):
+    """
+    Return a dict of {key: PIL image} for every region of a Kivy atlas
+    :param path:
+    :return:
+    """
+    with open(path) as file:
+        data = json.load(file)
+    r = {}
+    for image_name, regions in data.items():
+        image = Image.open(os.path.join(os.path.dirname(path), image_name))
+        image = image.convert('RGBA')
+        for key, (x, y, width, height) in regions.items():
+            #  Kivy atlas coordinates start at the bottom left corner
+            top = image.height - y - height
+            r[key] = image.crop((x, top, x + width, top + height))
+    return r
+
+
+def load_sprites(paths):
+    return {os.path.splitext(os.path.basename(path))[0]:
+            Image.open(path).convert('RGBA') for path in paths}
+
+
+def pack(images, size):
+    """
+    Place images on a square sheet of a given side, tallest first, in rows
+    :param images: a dict of {key: PIL image}
+    :param size:
+    :return: a dict of {key: (x, y from top)}
+    """
+    r = {}
+    x = y = row_height = 0
+    for key in sorted(images, key=lambda k: (-images[k].height, k)):
+        image = images[key]
+        if x + image.width > size:
+            x = 0
+            y += row_height + padding
+            row_height = 0
+        if y + image.height > size or image.width > size:
+            raise ValueError('Sprites do not fit in {0}x{0}'.format(size))
+        r[key] = (x, y)
+        x += image.width + padding
+        row_height = max(row_height, image.height)
+    return r
+
+
+def build(images, name, size):
+    """
+    Write `name`.atlas and `name`-0.png
+    :param images:
+    :param name: output path without extension
+    :param size:
+    :return:
+    """
+    positions = pack(images, size)
+    sheet = Image.new('RGBA', (size, size))
+    regions = {}
+    for key, (x, y) in positions.items():
+        image = images[key]
+        sheet.paste(image, (x, y))
+        regions[key] = [x, size - y - image.height, image.width, image.height]
+    image_name = '{}-0.png'.format(os.path.basename(name))
+    sheet.save(os.path.join(os.path.dirname(name), image_name))
+    with open(name + '.atlas', 'w') as file:
+        json.dump({image_name: regions}, file, sort_keys=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pack StackCity sprites')
+    parser.add_argument('--size', type=int, default=512,
+                        help='side of the atlas image, in pixels')
+    parser.add_argument('--output', default=os.path.join(base_path,
+                                                         'sprites'))
+    args = parser.parse_args(argv)
+    images = load_atlas_regions(os.path.join(base_path, 'grounds.atlas'))
+    images.update(load_sprites(os.path.join(base_path, x)
+                               for x in sprite_files))
+    build(images, args.output, args.size)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,44 +1,107 @@
 """
 A collection of buildings.
-All classes in this file inherit from cells.Building, overriding only
-`make_turn` and `__str__`.
-Probably later they will all be replaced by some sort of metaclass(?) magic that
-creates them from stored data, but for now it's easier to implement them as
-classes than get boggled with writing a proper composition-based system.
+Building types are defined in buildings.json and compiled into classes when
+this module is imported. Every type is based on one of the behaviours below,
+which implement the turn logic, and gets its name, image, acceptable ground,
+constructor defaults and production tables from the data. All of them use
+__slots__, so that buildings take as little memory as possible, and their
+per-turn logic only reads class-level tables.
+Adding a building type with an existing behaviour takes no code at all.
 """
 
-from cells import Placeable, Building
+import json
+import os
+
+from cells import Building, StackCityException, Ground
+from city import resource_index
+
+WORKFORCE = resource_index['workforce']
+
+buildings_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'buildings.json')
     
     
-class Dwelling(Building):
+class DwellingBehaviour(Building):
     """
-    A simple hut.
-    It starts empty and produces one dweller (ie a unit of workforce) every ten
-    turns. Five, if there is a neighbouring Dwelling. Placeable on living ground
+    A house.
+    It starts empty and gets a dweller (ie a unit of workforce) whenever its
+    growth counter reaches the threshold. The counter grows faster if there
+    is a neighbouring house of the same type
     """
-    def __init__(self, max_dwellers=5, *args, **kwargs):
-        super(Dwelling, self).__init__(*args, **kwargs)
-        # Growth counter set to 10 to return the initial worker upon placement
-        self.growth_counter = 10
+    __slots__ = ('growth_counter', 'dwellers', 'max_dwellers', 'growth_rate',
+                 'neighbour_growth_rate', 'growth_threshold', 'growth',
+                 'synced_turn')
+    saved_attributes = ('growth_counter', 'dwellers', 'max_dwellers')
+
+    def __init__(self, max_dwellers=5, growth_rate=1, neighbour_growth_rate=2,
+                 growth_threshold=10, *args, **kwargs):
+        super(DwellingBehaviour, self).__init__(*args, **kwargs)
+        #  Growth counter starts at the threshold to return the initial worker
+        #  upon placement
+        self.growth_counter = growth_threshold
         self.dwellers = 0
-        self.max_dwellers = 5
+        self.max_dwellers = max_dwellers
+        #  How much growth counter grows a turn, with and without neighbours,
+        #  and how much it takes to get a new dweller
+        self.growth_rate = growth_rate
+        self.neighbour_growth_rate = neighbour_growth_rate
+        self.growth_threshold = growth_threshold
+        #  Current growth a turn and the turn growth counter is correct for,
+        #  when scheduled. Growth counter isn't updated between dwellers
+        self.growth = 0
+        self.synced_turn = None
+
+    def has_neighbours(self):
+        """
+        Return True if there is a building of the same type next to this one
+        :return:
+        """
+        return self.cell_field.clusters.has_neighbour(self)
         
     def make_turn(self):
         if self.dwellers < self.max_dwellers:
-            has_neighbours = False
-            for cell in self.cell_field.get_neighbours(self.number):
-                if self.cell_field[cell].building and \
-                        self.cell_field[cell].building.name == self.name:
-                    has_neighbours = True
-                    break
-            if has_neighbours:
-                self.growth_counter += 2
+            if self.has_neighbours():
+                self.growth_counter += self.neighbour_growth_rate
             else:
-                self.growth_counter += 1
-            if self.growth_counter >= 10:
+                self.growth_counter += self.growth_rate
+            if self.growth_counter >= self.growth_threshold:
                 self.dwellers += 1
-                self.city_state.resources['workforce'] += 1
-                self.growth_counter -= 0
+                self.city_state.resources.amounts[WORKFORCE] += 1
+                self.growth_counter -= self.growth_threshold
+
+    def schedule(self, turn):
+        self.settle(turn)
+        if self.dwellers >= self.max_dwellers:
+            return None, ()
+        if self.has_neighbours():
+            self.growth = self.neighbour_growth_rate
+        else:
+            self.growth = self.growth_rate
+        #  The next dweller comes on the first turn the counter reaches the
+        #  threshold, but no sooner than next turn
+        missing = self.growth_threshold - self.growth_counter
+        if missing <= 0:
+            return turn + 1, ()
+        if self.growth <= 0:
+            return None, ()
+        return turn + max(1, -(-missing // self.growth)), ()
+
+    def act(self, turn):
+        self.settle(turn)
+        self.dwellers += 1
+        self.city_state.resources.amounts[WORKFORCE] += 1
+        self.growth_counter -= self.growth_threshold
+
+    def settle(self, turn):
+        if self.synced_turn is not None and self.dwellers < self.max_dwellers:
+            self.growth_counter += (turn - self.synced_turn)*self.growth
+        self.synced_turn = turn
+
+    def saved_state(self):
+        values = (self.growth_counter, self.dwellers, self.max_dwellers)
+        if self.synced_turn is None or self.dwellers >= self.max_dwellers:
+            return values, None, None
+        return values, self.synced_turn, (self.growth, 0, 0)
                 
     def on_placement(self):
         pass
@@ -51,22 +114,28 @@ class Dwelling(Building):
 
 class Workshop(Building):
     """
-    A base class for workshops. Realizes the workforce logic.
+    A building that needs workers to produce resources.
+    Workers come from workforce.WorkforceAllocator. What it produces and
+    consumes every turn is set by its type
     """
+    __slots__ = ('workers', 'workers_required')
+    saved_attributes = ('workers', 'workers_required')
+    #  Tuples of (resource slot index, amount) produced and consumed every
+    #  turn, see city.ResourceLedger
+    produces = ()
+    consumes = ()
+    #  If False, a workshop with any workers at all works at full capacity
+    full_staff_only = True
+
     def __init__(self, workers_required=1, **kwargs):
         super(Workshop, self).__init__(**kwargs)
         self.workers = 0
         self.workers_required = workers_required
     
     def on_placement(self):
-        #  A workshop claims as many workers as it needs (or at least as many as
-        # it can) right after placement
-        if self.city_state.resources['workforce'] >= self.workers_required:
-            self.city_state.resources['workforce'] -= self.workers_required
-            self.workers = self.workers_required
-        elif self.city_state.resources['workforce'] > 0:
-            self.workers = self.city_state.resources['workforce']
-            self.city_state.resources['workforce'] = 0
+        #  Workers are assigned by the engine's workforce.WorkforceAllocator,
+        #  right after placement and whenever there are free ones
+        pass
             
     def work_efficiency(self):
         """
@@ -78,6 +147,35 @@ class Workshop(Building):
         :return:
         """
         return self.workers/self.workers_required
+
+    def is_working(self):
+        """
+        Return True if this workshop has enough workers to work at all
+        :return:
+        """
+        return self.workers > 0 and (not self.full_staff_only or
+                                     self.workers >= self.workers_required)
+
+    def make_turn(self):
+        if not self.is_working():
+            return
+        amounts = self.city_state.resources.amounts
+        #  Nothing is produced unless everything consumed is available
+        for index, amount in self.consumes:
+            if amounts[index] < amount:
+                return
+        for index, amount in self.consumes:
+            amounts[index] -= amount
+        for index, amount in self.produces:
+            amounts[index] += amount
+
+    def schedule(self, turn):
+        if not self.is_working():
+            return None, ()
+        if self.consumes:
+            #  Whether it works depends on what's in stock, so every turn
+            return turn + 1, ()
+        return None, self.produces
             
     def __str__(self):
         # Mention if it's understaffed in the name
@@ -88,40 +186,78 @@ class Workshop(Building):
         else:
             return '{} (unmanned)'.format(self.name)
 
-    
-class FisherBoat(Workshop):
+
+#  Behaviours by the names used in buildings.json
+behaviours = {'dwelling': DwellingBehaviour,
+              'workshop': Workshop}
+
+
+def _resource_table(amounts):
     """
-    A fisher boat.
-    Requires a unit of workforce. Produces two food a turn. Placeable on water.
+    Turn a {resource: amount} dict into a tuple of (slot index, amount)
+    :param amounts:
+    :return:
     """
-    
-    def make_turn(self):
-        if self.work_efficiency():
-            self.city_state.resources['food'] += 1
-    
+    for name in amounts:
+        if name not in resource_index:
+            raise StackCityException('Unknown resource {}'.format(name))
+    return tuple(sorted((resource_index[name], amount)
+                        for name, amount in amounts.items()))
+
 
-class Smithery(Workshop):
+def compile_building_type(definition):
     """
-    A simple workshop.
-    Requires two units of workforce. Produces one gold a turn. Placeable on
-    an infrastructure ground
+    Create a building class from its definition in buildings.json
+    :param definition:
+    :return:
     """
-    def make_turn(self):
-        if self.work_efficiency() == 1:
-            self.city_state.resources['gold'] += 1
-    
-    
-    
-class Barracks(Building):
+    if definition['behaviour'] not in behaviours:
+        raise StackCityException('Unknown behaviour {}'.format(
+            definition['behaviour']))
+    base = behaviours[definition['behaviour']]
+    for ground_type in definition['ground']:
+        if ground_type not in Ground.ground_types:
+            raise StackCityException('Unknown ground type')
+    #  Constructor arguments, which can still be overridden per building
+    defaults = dict(name=definition['name'],
+                    image_source=definition['image'],
+                    acceptable_ground=tuple(definition['ground']),
+                    **definition.get('params', {}))
+
+    def __init__(self, **kwargs):
+        base.__init__(self, **dict(defaults, **kwargs))
+
+    namespace = {'__slots__': (),
+                 '__init__': __init__,
+                 '__doc__': definition.get('description', ''),
+                 'item': definition['item'],
+                 'defaults': defaults}
+    if base is Workshop:
+        namespace['produces'] = _resource_table(definition.get('produces', {}))
+        namespace['consumes'] = _resource_table(definition.get('consumes', {}))
+        namespace['full_staff_only'] = definition.get('full_staff_only', True)
+    return type(definition['class'], (base, ), namespace)
+
+
+def load_building_types(path=buildings_path):
     """
-    A barrack. Requires two units of workforce, consumes one gold a turn,
-    doesn't do shit. Placeable on a military ground.
+    Compile all building types from a file
+    :param path:
+    :return: a dict of classes by item name and a tuple of names of items
+    that the item factory should generate
     """
-    def make_turn(self):
-        pass
-    
-    def on_placement(self):
-        pass
-    
-    def __str__(self):
-        pass
+    with open(path) as file:
+        data = json.load(file)
+    types = {}
+    spawned = []
+    for definition in data['buildings']:
+        types[definition['item']] = compile_building_type(definition)
+        if definition.get('spawn', True):
+            spawned.append(definition['item'])
+    return types, tuple(spawned)
+
+
+#  Building classes by item name and the items that are generated in game
+building_types, spawned_buildings = load_building_types()
+#  All building classes by class name, for restoring buildings from saves
+building_classes = {cls.__name__: cls for cls in building_types.values()}
@@ -2,6 +2,10 @@
 Classes for various stuff that can be placed on a map
 """
 
+from array import array
+
+from clusters import ClusterIndex
+
 
 #  This class should go to something like util.py, when I make that file
 class StackCityException(Exception):
@@ -20,17 +24,90 @@ class Cell:
     building: whether this cell is occupied or not.
     It also stores a cell number which is set when the cell is placed into a
     CellGrid and can later be used to look up its neighbours.
+    A Cell that is not in a CellField keeps its qualities by itself. Once it
+    is appended to a field, it becomes a lightweight view: the qualities are
+    stored in the field's arrays and the Cell only remembers its number.
+    CellField also creates such views on the fly when indexed.
     """
+    __slots__ = ('field', 'number', '_ground', '_bonus', '_built',
+                 '_building')
+
     def __init__(self, ground=None, bonus=None):
+        self.field = None
+        self.number = None
         if ground:
-            self.ground = ground
+            self._ground = ground
         else:
-            self.ground = Ground('empty')
-        self.bonus = bonus
-        self.built = False
-        self.number = None
+            self._ground = Ground('empty')
+        self._bonus = bonus
+        self._built = False
         # A ref to the building, should it be placed on this cell
-        self.building = None
+        self._building = None
+
+    @classmethod
+    def view(cls, field, number):
+        """
+        Create a Cell that is a view of cell #number in a given CellField
+        :param field:
+        :param number:
+        :return:
+        """
+        r = cls.__new__(cls)
+        r.field = field
+        r.number = number
+        return r
+
+    @property
+    def ground(self):
+        if self.field is None:
+            return self._ground
+        return grounds_by_code[self.field.grounds[self.number]]
+
+    @ground.setter
+    def ground(self, value):
+        if self.field is None:
+            self._ground = value
+        else:
+            self.field.set_ground(self.number, value.ground_type)
+
+    @property
+    def bonus(self):
+        if self.field is None:
+            return self._bonus
+        return self.field.bonus_types[self.field.bonuses[self.number]]
+
+    @bonus.setter
+    def bonus(self, value):
+        if self.field is None:
+            self._bonus = value
+        else:
+            self.field.set_bonus(self.number, value)
+
+    @property
+    def built(self):
+        if self.field is None:
+            return self._built
+        return bool(self.field.built[self.number])
+
+    @built.setter
+    def built(self, value):
+        if self.field is None:
+            self._built = value
+        else:
+            self.field.set_built(self.number, value)
+
+    @property
+    def building(self):
+        if self.field is None:
+            return self._building
+        return self.field.building_at(self.number)
+
+    @building.setter
+    def building(self, value):
+        if self.field is None:
+            self._building = value
+        else:
+            self.field.set_building(self.number, value)
 
     def can_accept(self, item):
         """
@@ -39,6 +116,9 @@ class Cell:
         :return:
         """
         # Currently a placeholder
+        if isinstance(item, Building) and self.built:
+            # One building per cell
+            return False
         if self.ground.ground_type in item.acceptable_ground:
             return True
         else:
@@ -64,39 +144,164 @@ class Cell:
 class CellField:
     """
     A grid of cells.
-    This class is a list of cells. It supports operations such as addressing any
-    cell, adding or removing cells, etc.
+    This class behaves like a list of cells. It supports operations such as
+    addressing any cell, adding cells, etc.
+    Cells are not stored as objects: ground types, bonuses, built flags and
+    building IDs live in flat typed arrays indexed by cell number, and
+    indexing the field returns a Cell view. Ground types and bonuses are stored
+    as codes, ie indices in `ground_type_list` and `self.bonus_types`.
+    Building IDs are indices in `self.buildings`, -1 meaning no building.
     """
     def __init__(self, field_size):
         self.field_size = field_size
-        self.cells = [None for x in range(self.field_size*self.field_size)]
+        cell_count = self.field_size*self.field_size
+        self.grounds = bytearray(cell_count)
+        self.bonuses = bytearray(cell_count)
+        self.built = bytearray(cell_count)
+        self.building_ids = array('i', [-1])*cell_count
+        #  Bonus codes are assigned as new bonus types show up
+        self.bonus_types = [None]
+        self.buildings = []
+        #  How many cells were appended
+        self.filled = 0
         self.city_state = None
+        #  Created on first use, see `clusters`
+        self._clusters = None
+        #  Numbers of cells changed since the set was last emptied, if
+        #  anybody keeps track of them (see autosave.py)
+        self.changed = None
+
+    def __len__(self):
+        return self.field_size*self.field_size
 
     def __getitem__(self, item):
-        return self.cells[item]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < self.filled:
+            raise IndexError('Cell number out of range')
+        return Cell.view(self, item)
     
     def connect_citystate(self, state):
         """
         Connect to the CityState object.
-        The class variable assignment hack is not used here, because attaching
-        a city state may later mean more than just variable assignment in the
-        future.
+        Buildings placed on this field use it as their city state, see
+        Building.city_state
         :param state:
         :return:
         """
         self.city_state = state
 
     def append(self, item):
+        """
+        Put a cell into the first free slot.
+        The cell's qualities are copied into the field and the cell itself
+        becomes a view of this field
+        :param item:
+        :return:
+        """
         assert isinstance(item, Cell)
-        placed = False
-        for x in range(len(self.cells)):
-            if not self.cells[x]:
-                self.cells[x] = item
-                item.number = x
-                placed = True
-                break
-        if not placed:
+        if self.filled >= len(self):
             raise StackCityException('Adding cell to a field that is full!')
+        number = self.filled
+        self.filled += 1
+        ground, bonus, built, building = \
+            item.ground, item.bonus, item.built, item.building
+        item.field = self
+        item.number = number
+        item.ground = ground
+        item.bonus = bonus
+        item.built = built
+        if building:
+            item.building = building
+
+    def populate(self, ground_type='empty'):
+        """
+        Fill all free slots with cells of a given ground type at once.
+        Equivalent to, but much faster than appending Cell(Ground(ground_type))
+        until the field is full
+        :param ground_type:
+        :return:
+        """
+        code = ground_codes[ground_type]
+        self.grounds[self.filled:] = bytes([code])*(len(self) - self.filled)
+        self.filled = len(self)
+
+    def ground_type(self, number):
+        """
+        Return the ground type name of cell #number
+        :param number:
+        :return:
+        """
+        return ground_type_list[self.grounds[number]]
+
+    def set_ground(self, number, ground_type):
+        self.grounds[number] = ground_codes[ground_type]
+        if self.changed is not None:
+            self.changed.add(number)
+
+    def set_bonus(self, number, bonus):
+        if bonus not in self.bonus_types:
+            self.bonus_types.append(bonus)
+        self.bonuses[number] = self.bonus_types.index(bonus)
+        if self.changed is not None:
+            self.changed.add(number)
+
+    def set_built(self, number, built):
+        self.built[number] = 1 if built else 0
+        if self.changed is not None:
+            self.changed.add(number)
+
+    def building_at(self, number):
+        """
+        Return a building on cell #number or None if there isn't any
+        :param number:
+        :return:
+        """
+        building_id = self.building_ids[number]
+        if building_id < 0:
+            return None
+        return self.buildings[building_id]
+
+    def set_building(self, number, building):
+        """
+        Put a building on cell #number, registering it in this field
+        :param number:
+        :param building:
+        :return:
+        """
+        if self.changed is not None:
+            self.changed.add(number)
+        if building is None:
+            self.building_ids[number] = -1
+            return
+        if building.building_id is None:
+            building.building_id = len(self.buildings)
+            self.buildings.append(building)
+            self.building_ids[number] = building.building_id
+            if self._clusters is not None:
+                self._clusters.add(building)
+        else:
+            self.building_ids[number] = building.building_id
+
+    @property
+    def clusters(self):
+        """
+        A clusters.ClusterIndex of the buildings, built on first use and
+        kept up to date as buildings are placed
+        :return:
+        """
+        if self._clusters is None:
+            self._clusters = ClusterIndex(self)
+        return self._clusters
+
+    @property
+    def neighbour_table(self):
+        """
+        A flat table of neighbours: eight cell numbers per cell, see
+        `neighbour_table`
+        :return:
+        """
+        return neighbour_table(self.field_size)
 
     def get_neighbours(self, number):
         """
@@ -111,32 +316,67 @@ class CellField:
         :param number:
         :return:
         """
-        r = []
-        # if's within list declarations check for going beyond left&right map borders
-        # maps check for going beyond upper and lower borders
-        upper = [number-self.field_size-1 if number % self.field_size > 0 else None,
-                 number-self.field_size,
-                 number-self.field_size+1 if number % self.field_size < self.field_size-1 else None]
-        r += map(lambda x: x if x and x > 0 else None, upper)
-        if number % self.field_size > 0:
-            r.append(number-1)
-        else:
-            r.append(None)
-        if number % self.field_size < self.field_size-1:
-            r.append(number+1)
-        else:
-            r.append(None)
-        lower = [number+self.field_size-1 if number % self.field_size > 0 else None,
-                 number+self.field_size,
-                 number+self.field_size+1 if number % self.field_size < self.field_size-1 else None]
-        r += map(lambda x: x if x and x < self.field_size*self.field_size else None, lower)
+        return [None if x < 0 else x
+                for x in self.neighbour_table[number*8:number*8+8]]
+
+    def get_neighbourhood(self, numbers):
+        """
+        Return a set of cells that neighbour any of `numbers`, not including
+        `numbers` themselves
+        :param numbers:
+        :return:
+        """
+        table = self.neighbour_table
+        r = set()
+        for n in numbers:
+            r.update(table[n*8:n*8+8])
+        r.discard(-1)
+        r.difference_update(numbers)
         return r
 
 
+#  Neighbour tables are the same for all fields of a given size
+_neighbour_tables = {}
+
+
+def neighbour_table(field_size):
+    """
+    Return a neighbour table for a square field of a given size.
+    It is a flat array with eight elements per cell: neighbours of cell n are
+    table[n*8:n*8+8], ordered like in `CellField.get_neighbours`. Neighbours
+    beyond field borders are -1. Tables are built once per field size
+    :param field_size:
+    :return:
+    """
+    if field_size in _neighbour_tables:
+        return _neighbour_tables[field_size]
+    cell_count = field_size*field_size
+    table = array('i', [-1])*(cell_count*8)
+    border = array('i', [-1])*field_size
+    offsets = ((-1, -1), (-1, 0), (-1, 1), (0, -1),
+               (0, 1), (1, -1), (1, 0), (1, 1))
+    for index, (dy, dx) in enumerate(offsets):
+        shift = dy*field_size + dx
+        direction = array('i', range(shift, cell_count + shift))
+        if dx < 0:
+            direction[0::field_size] = border
+        elif dx > 0:
+            direction[field_size-1::field_size] = border
+        if dy < 0:
+            direction[:field_size] = border
+        elif dy > 0:
+            direction[cell_count-field_size:] = border
+        table[index::8] = direction
+    _neighbour_tables[field_size] = table
+    return table
+
+
 class Placeable:
     """
     Something that can be placed on the field
     """
+    __slots__ = ('acceptable_ground', 'cell_field', 'number')
+
     def __init__(self, acceptable_ground=('empty', )):
         #  The ground this can be placed on
         self.acceptable_ground = acceptable_ground
@@ -156,31 +396,67 @@ class Placeable:
             self.on_placement()
 
 
+#  Ground types in the order of their codes in CellField arrays
+ground_type_list = ('empty', 'water', 'living', 'military', 'infrastructure')
+ground_codes = {name: code for code, name in enumerate(ground_type_list)}
+
+
 class Ground(Placeable):
     """
-    A class for ground type
+    A class for ground type.
+    Grounds are immutable flyweights: there is a single Ground per ground
+    type, and Ground(ground_type) returns that one instead of creating a new
+    object. All grounds can be placed on empty ground only
     """
-    ground_types = {'empty', 'water', 'living', 'military', 'infrastructure'}
+    __slots__ = ('ground_type', 'code')
+    ground_types = set(ground_type_list)
+    #  Interned instances by ground type
+    _instances = {}
 
-    def __init__(self, ground_type, **kwargs):
-        super(Ground, self).__init__(**kwargs)
-        if not ground_type in self.ground_types:
+    def __new__(cls, ground_type):
+        try:
+            return cls._instances[ground_type]
+        except KeyError:
+            pass
+        if not ground_type in cls.ground_types:
             raise StackCityException('Unknown ground type')
-        self.ground_type = ground_type
+        r = super(Ground, cls).__new__(cls)
+        for name, value in (('acceptable_ground', ('empty', )),
+                            ('cell_field', None),
+                            ('number', None),
+                            ('ground_type', ground_type),
+                            ('code', ground_codes[ground_type])):
+            object.__setattr__(r, name, value)
+        cls._instances[ground_type] = r
+        return r
+
+    def __init__(self, ground_type):
+        #  Everything is set up in __new__, once per ground type
+        pass
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Ground objects are immutable')
+
+    def __reduce__(self):
+        return Ground, (self.ground_type, )
 
     # String representation just in case
     def __str__(self):
         return self.ground_type
 
 
+#  Ground flyweights in the order of their codes
+grounds_by_code = tuple(Ground(x) for x in ground_type_list)
+
+
 class Building(Placeable):
     """
     A backend base class for the buildings
     """
-    # A city state class variable. It is set by game.CityGame.init_game to allow
-    # all buildings easy access to the city state. Obviously, this implies that
-    # a CityState object must be a singleton
-    city_state = None
+    #  Integer attributes that make up the building's state and are stored in
+    #  saves, along with its name, image and acceptable ground
+    saved_attributes = ()
+    __slots__ = ('name', 'effect', 'image_source', 'widget', 'building_id')
     
     def __init__(self, image_source='House.png',
                  name='BaseBuilding', effect=None, **kwargs):
@@ -189,10 +465,24 @@ class Building(Placeable):
         self.effect = effect
         self.image_source = image_source
         self.widget = None
+        #  Set by CellField when the building is put on a field
+        self.building_id = None
 
     def __str__(self):
         return self.name
 
+    @property
+    def city_state(self):
+        """
+        The CityState of the city this building is placed in, or None if it
+        isn't placed yet. Buildings get it through their field, so any number
+        of cities can live side by side
+        :return:
+        """
+        if self.cell_field is None:
+            return None
+        return self.cell_field.city_state
+
     def make_turn(self):
         """
         What this building does every turn.
@@ -200,6 +490,48 @@ class Building(Placeable):
         :return:
         """
         raise NotImplementedError('`Building` is a base class to inherit from')
+
+    def schedule(self, turn):
+        """
+        Tell the scheduler (see scheduler.py) what this building does after
+        turn `turn`. Unless overridden, it acts every turn.
+        Called after placement, after every action and whenever a
+        neighbouring building is placed
+        :param turn: the last turn processed
+        :return: (turn of the next `act` call or None if there isn't any,
+        a tuple of (resource slot, amount) produced every turn)
+        """
+        return turn + 1, ()
+
+    def act(self, turn):
+        """
+        Do what this building was scheduled to do on turn `turn`
+        :param turn:
+        :return:
+        """
+        self.make_turn()
+
+    def settle(self, turn):
+        """
+        Bring this building's state up to date with turn `turn`. Only
+        buildings whose state changes between their actions need it
+        :param turn:
+        :return:
+        """
+        pass
+
+    def saved_state(self):
+        """
+        Return the values of saved_attributes without settling, for saving
+        the building later without touching it again. Values that change
+        between actions (see `settle`) come with the turn they are correct
+        for and how much each of them changes a turn until the building is
+        next scheduled
+        :return: (tuple of values, turn or None, tuple of changes a turn or
+        None if the values don't change)
+        """
+        return tuple(getattr(self, x) for x in self.saved_attributes), \
+            None, None
     
     def on_placement(self):
         """
@@ -2,40 +2,115 @@
 The logic of the city as a whole
 """
 
+import mmap
 from collections import namedtuple
+from collections.abc import MutableMapping
 
 Resource = namedtuple('Resource', 'name icon_source')
 resources = {'gold': Resource(name='Gold', icon_source='Coins.png'),
              'food': Resource(name='Food', icon_source='Food.png'),
              'workforce': Resource(name='Workforce', icon_source='Worker.png')}
+#  Resource names in the order of their slots in a ResourceLedger
+resource_names = tuple(resources)
+resource_index = {name: index for index, name in enumerate(resource_names)}
+
+
+class ResourceLedger(MutableMapping):
+    """
+    Amounts of all resources of a city.
+    Every resource has a fixed slot in `amounts`, so buildings can add their
+    production by slot index (see resource_index) without any dict lookups.
+    The ledger still works as a dict of amounts by resource name for
+    everything else.
+    The amounts at the last publish() are kept as well, so the deltas
+    accumulated since then cost nothing to track. publish() tells the
+    listeners about resources whose amounts have changed.
+    """
+    def __init__(self):
+        self.amounts = [0]*len(resource_names)
+        self.published = list(self.amounts)
+        #  Callables taking a dict of {resource name: amount}
+        self.listeners = []
+
+    def __getitem__(self, name):
+        return self.amounts[resource_index[name]]
+
+    def __setitem__(self, name, value):
+        self.amounts[resource_index[name]] = value
+
+    def __delitem__(self, name):
+        raise TypeError('Resources cannot be removed from a ledger')
+
+    def __iter__(self):
+        return iter(resource_names)
+
+    def __len__(self):
+        return len(resource_names)
+
+    def __repr__(self):
+        return 'ResourceLedger({!r})'.format(dict(self))
+
+    def deltas(self):
+        """
+        Return a dict of changes of every resource since the last publish()
+        :return:
+        """
+        return {name: self.amounts[index] - self.published[index]
+                for index, name in enumerate(resource_names)}
+
+    def changes(self):
+        """
+        Return a dict of amounts of resources that have changed since the
+        last publish()
+        :return:
+        """
+        return {name: self.amounts[index]
+                for index, name in enumerate(resource_names)
+                if self.amounts[index] != self.published[index]}
+
+    def publish(self, everything=False):
+        """
+        Call the listeners with the changed resources, if there are any, and
+        start accumulating deltas anew
+        :param everything: if True, all resources are published
+        :return:
+        """
+        changes = dict(self) if everything else self.changes()
+        self.published = list(self.amounts)
+        if changes:
+            for listener in self.listeners:
+                listener(changes)
 
 
 class CityState:
     """
     An object that remembers the state of the entire city.
     Resources amounts, research, foreign affairs, etc. all go here.
-    It is a singleton; two objects of this type cannot be used simultaneously
-    (although more can *exist in memory*, assuming CityGame object did not
-    assign more than one as active).
+    Every city has its own; buildings find theirs through the CellField they
+    are placed on.
     """
     
     def __init__(self, name='Irkutsk'):
         self.name = name
         #  How many of each resource is stored
-        self.resources = {'gold': 0,
-                          'food': 0,
-                          'workforce': 0}
+        self.resources = ResourceLedger()
     
-    def load_from_file(self):
+    def load_from_file(self, path):
         """
-        A stub. Sometime there will be a system to save and load city
+        Load name and resources from a save file (see saves.py). The rest of
+        the city is loaded by saves.load_city
+        :param path:
         :return:
         """
-        raise NotImplementedError('The saves will work... sometime')
+        #  Imported here, as saves imports the engine, which imports this
+        from saves import SaveReader
+        with open(path, 'rb') as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                with SaveReader(buffer) as reader:
+                    self.name, resources = reader.read_state()
+        self.resources.update(resources)
     
     def __str__(self):
-        """
-        Serialize an entire city to be saved
-        :return:
-        """
-        raise NotImplementedError('The saves will work... sometime')
+        return '{}: {}'.format(self.name, ', '.join(
+            '{} {}'.format(amount, name)
+            for name, amount in self.resources.items()))
@@ -0,0 +1,91 @@
+"""
+Clusters of neighbouring buildings of the same type.
+Buildings of the same type (ie with the same name) that touch each other,
+diagonally included, form a cluster. Clusters are kept in a union-find
+structure that is updated when a building is placed, so that adjacency
+bonuses can ask whether a building has a neighbour of its type, or how
+large its cluster is, without looking at the neighbours at all.
+Buildings are never removed, so clusters only ever merge.
+"""
+
+from array import array
+
+
+class ClusterIndex:
+    """
+    Same-type clusters of the buildings of a CellField, by building_id
+    """
+    def __init__(self, cell_field):
+        self.cell_field = cell_field
+        #  Union-find parents and, for roots, cluster sizes
+        self.parents = array('i')
+        self.sizes = array('i')
+        #  1 for buildings with at least one neighbour of their type
+        self.connected = bytearray()
+        for building in cell_field.buildings:
+            self.add(building)
+
+    def add(self, building):
+        """
+        Add a building that has just been placed
+        :param building:
+        :return:
+        """
+        building_id = building.building_id
+        while len(self.parents) <= building_id:
+            self.parents.append(len(self.parents))
+            self.sizes.append(1)
+            self.connected.append(0)
+        table = self.cell_field.neighbour_table
+        base = building.number*8
+        for cell in table[base:base+8]:
+            if cell < 0:
+                continue
+            neighbour_id = self.cell_field.building_ids[cell]
+            if neighbour_id < 0 or neighbour_id == building_id or \
+                    neighbour_id >= len(self.parents):
+                continue
+            if self.cell_field.buildings[neighbour_id].name == building.name:
+                self.connected[building_id] = 1
+                self.connected[neighbour_id] = 1
+                self.union(building_id, neighbour_id)
+
+    def find(self, building_id):
+        """
+        Return the id of the root of a building's cluster
+        :param building_id:
+        :return:
+        """
+        parents = self.parents
+        while parents[building_id] != building_id:
+            #  Path halving
+            parents[building_id] = parents[parents[building_id]]
+            building_id = parents[building_id]
+        return building_id
+
+    def union(self, first, second):
+        first = self.find(first)
+        second = self.find(second)
+        if first == second:
+            return
+        if self.sizes[first] < self.sizes[second]:
+            first, second = second, first
+        self.parents[second] = first
+        self.sizes[first] += self.sizes[second]
+
+    def has_neighbour(self, building):
+        """
+        Return True if a building touches another one of its type
+        :param building:
+        :return:
+        """
+        return bool(self.connected[building.building_id])
+
+    def cluster_size(self, building):
+        """
+        Return the number of buildings in a building's cluster, itself
+        included
+        :param building:
+        :return:
+        """
+        return self.sizes[self.find(building.building_id)]
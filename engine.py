@@ -0,0 +1,235 @@
+"""
+A headless game engine.
+It places items and makes turns without any widgetry, so the same game logic
+can be driven by the Kivy UI, by balancing scripts, tests or a server.
+Neither this module nor anything it imports may import Kivy.
+"""
+
+from cells import CellField, Building, StackCityException, ground_type_list
+from city import CityState
+from factories import NextItemFactory
+from misc import name_ground_list
+from placement import PlacementFinder
+from scheduler import TurnScheduler
+from workforce import WorkforceAllocator
+from shapes import GroundBlock, Shape
+
+
+def describe_item(item):
+    """
+    Return a human-readable name for an item (a building or a ground block)
+    :param item:
+    :return:
+    """
+    if isinstance(item, Building):
+        return str(item)
+    elif isinstance(item, list):
+        # Assuming only ground comes in lists
+        return name_ground_list(item)
+    return ''
+
+
+class CityEngine:
+    """
+    A single StackCity game.
+    It owns a CellField, a CityState and a NextItemFactory and implements the
+    turn logic that used to live in game.CityGame.start_turn. A turn starts
+    with generating the next item; the item is then either placed or rerolled,
+    both of which start another turn.
+    Ground blocks are nested lists of Ground objects (or Nones), exactly like
+    NextItemFactory makes them. They are anchored by their middle element and
+    their rows go bottom-up, the way GrabbableGroundGroup displays them.
+    """
+    def __init__(self, field_size=18, city_name='Irkutsk', seed=None,
+                 item_weights=None, building_params=None):
+        self.cell_field = CellField(field_size=field_size)
+        self.cell_field.connect_citystate(CityState(name=city_name))
+        self.cell_field.populate()
+        self.city_state = self.cell_field.city_state
+        self.next_item_factory = NextItemFactory(
+            self.cell_field, seed=seed, item_weights=item_weights,
+            building_params=building_params)
+        #  Buildings in the order of placement
+        self.buildings = self.cell_field.buildings
+        self.next_item = None
+        self.turn = 0
+        #  A journal.Journal recording player actions, if any
+        self.journal = None
+        #  An instruments.Instruments collecting per-turn stats, if any
+        self.instruments = None
+        #  An autosave.Autosaver saving the city after every turn, if any
+        self.autosaver = None
+        #  Created on first use, see `scheduler`
+        self._scheduler = None
+        self.placement = PlacementFinder(self.cell_field)
+
+    @property
+    def field_size(self):
+        return self.cell_field.field_size
+
+    @property
+    def scheduler(self):
+        """
+        The TurnScheduler of this city's buildings, with a
+        WorkforceAllocator staffing the workshops. It is only created when
+        needed, so that loading a city doesn't decode all the buildings
+        :return:
+        """
+        if self._scheduler is None:
+            self._scheduler = TurnScheduler(self.cell_field, self.turn)
+            self._scheduler.allocator = WorkforceAllocator(
+                self.cell_field, on_change=self._scheduler.reschedule)
+        return self._scheduler
+
+    def start_turn(self):
+        """
+        Generate the next item and let all the buildings make their turn
+        :return: the next item
+        """
+        self.next_item = self.next_item_factory.create_item()
+        if self.instruments is None:
+            self.scheduler.advance(1)
+        else:
+            self.instruments.make_turns(self)
+        self.turn += 1
+        if self.autosaver is not None:
+            self.autosaver.turn_started(self)
+        return self.next_item
+
+    def reroll(self):
+        """
+        Skip the current item
+        :return: the next item
+        """
+        turn = self.turn
+        self.start_turn()
+        if self.journal is not None:
+            self.journal.record_reroll(self, turn)
+        return self.next_item
+
+    def fast_forward(self, turns):
+        """
+        Let the city live for `turns` turns without any player actions.
+        No items are generated, so the next item stays the same. It costs
+        about as much as the building events in these turns, however many
+        turns there are
+        :param turns:
+        :return:
+        """
+        if turns < 0:
+            raise StackCityException(
+                'Cannot fast forward {} turns'.format(turns))
+        turn = self.turn
+        self.scheduler.advance(turns)
+        self.turn += turns
+        if self.journal is not None:
+            self.journal.record_fast_forward(self, turn, turns)
+
+    def settle(self):
+        """
+        Bring the state of all the buildings up to date, eg before saving.
+        Some of it is only updated when buildings act otherwise
+        :return:
+        """
+        if self._scheduler is not None:
+            self._scheduler.settle()
+
+    def block_targets(self, block, number):
+        """
+        Return a list of (cell number, ground) pairs a ground block would
+        cover if its middle element was put on cell #number. Return None if
+        any part of the block falls outside the field.
+        :param block:
+        :param number:
+        :return:
+        """
+        size = self.cell_field.field_size
+        row, col = divmod(number, size)
+        #  Plain nested lists don't come with a precomputed shape
+        shape = block.shape if isinstance(block, GroundBlock) else Shape(block)
+        r = []
+        for (y, x), (row_offset, col_offset) in zip(shape.cells,
+                                                    shape.offsets):
+            target_row = row + row_offset
+            target_col = col + col_offset
+            if not (0 <= target_row < size and 0 <= target_col < size):
+                return None
+            r.append((target_row*size + target_col, block[y][x]))
+        return r
+
+    def can_place(self, item, number):
+        """
+        Return True if the item can be placed on cell #number
+        :param item:
+        :param number:
+        :return:
+        """
+        if not 0 <= number < len(self.cell_field):
+            return False
+        if isinstance(item, Building):
+            return self.cell_field[number].can_accept(item)
+        targets = self.block_targets(item, number)
+        if targets is None:
+            return False
+        grounds = self.cell_field.grounds
+        for target, ground in targets:
+            if ground_type_list[grounds[target]] not in \
+                    ground.acceptable_ground:
+                return False
+        return True
+
+    def legal_placements(self, item=None):
+        """
+        Return a list of all cell numbers an item (the next item by default)
+        can be placed on
+        :param item:
+        :return:
+        """
+        return self.placement.legal_anchors(item or self.next_item)
+
+    def has_moves(self):
+        """
+        Return True if the next item can be placed anywhere
+        :return:
+        """
+        return self.placement.has_legal_anchor(self.next_item)
+
+    def place_item(self, item, number):
+        """
+        Place an item on cell #number.
+        Does *not* start the next turn.
+        :param item:
+        :param number:
+        :return: a list of cell numbers that have changed
+        """
+        if not self.can_place(item, number):
+            raise StackCityException('Cannot place {} on cell {}'.format(
+                describe_item(item), number))
+        if isinstance(item, Building):
+            item.get_placed(cell_field=self.cell_field, number=number)
+            self.cell_field[number].add_item(item)
+            self.cell_field[number].built = True
+            self.scheduler.allocator.add(item)
+            self.scheduler.add(item)
+            return [number]
+        changed = []
+        for target, ground in self.block_targets(item, number):
+            self.cell_field.set_ground(target, ground.ground_type)
+            changed.append(target)
+        return changed
+
+    def play(self, number):
+        """
+        Place the next item on cell #number and start the next turn.
+        Return None if it couldn't be placed there
+        :param number:
+        :return: a list of cell numbers that have changed
+        """
+        if not self.can_place(self.next_item, number):
+            return None
+        turn = self.turn
+        changed = self.place_item(self.next_item, number)
+        self.start_turn()
+        if self.journal is not None:
+            self.journal.record_placement(self, turn, number)
+        return changed
@@ -1,101 +1,404 @@
 #! /usr/bin/python3
 
+import os
+import threading
+
 from kivy.app import App
 from kivy.animation import Animation
 from kivy.clock import Clock
-from kivy.properties import ListProperty, ObjectProperty, DictProperty,\
-    StringProperty
+from kivy.graphics import Color, InstructionGroup, Mesh, PopMatrix, \
+    PushMatrix, Rectangle, Scale, Translate
+from kivy.properties import NumericProperty, ObjectProperty, StringProperty
 from kivy.uix.widget import Widget
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.gridlayout import GridLayout
-from kivy.uix.floatlayout import FloatLayout
 from kivy.uix.label import Label
+from kivy.uix.stencilview import StencilView
 
 # Game engine
-# from buildings import Building
-from cells import Cell, CellField, Building
-from city import CityState, resources as resource_reference
-from factories import NextItemFactory
-from misc import shape_copy, name_ground_list
+from autosave import Autosaver
+from bot import MonteCarloBot, PLACE
+from cells import Cell, Building
+from city import resources as resource_reference
+from engine import CityEngine, describe_item
+from instruments import Instruments
+from journal import Journal
+from misc import shape_copy
+import saves
+import textures
+import tiles
+from viewport import Viewport
 
 
 class CityGame(Widget):
-    #  An item to be attached
-    next_item = ObjectProperty(None)
+    """
+    The game widget.
+    A thin view over engine.CityEngine: all the game logic lives in the engine,
+    this class only passes player actions to it and updates widgetry
+    """
+    #  An item to be attached. Items are compared by identity: a new ground
+    #  block of the same shape and ground as the last one is an equal list,
+    #  but the widgets still have to show it
+    next_item = ObjectProperty(None, comparator=lambda a, b: a is b)
     #  A field backend
     cell_field = ObjectProperty(None)
-    #  Resources view
-    resources = DictProperty(None)
-    #  buildings list
-    buildings = ListProperty(None)
 
     def __init__(self, **kwargs):
         super(CityGame, self).__init__(**kwargs)
-        self.cell_field = CellField(field_size=18)
-        self.cell_field.connect_citystate(CityState())
-        self.resources = self.cell_field.city_state.resources
-        self.next_item_factory = NextItemFactory(self.cell_field)
+        #  The engine is created in init_game, after the first frame
+        self.engine = None
+        #  A city.ResourceLedger
+        self.resources = None
+        #  Per-turn stats overlay, off unless enabled in config
+        self.stats_label = None
+        if App.get_running_app().config.getboolean('stackcity', 'profile'):
+            self.stats_label = Label(halign='left', valign='top',
+                                     size_hint=(None, None),
+                                     size=(300, 150))
+            self.stats_label.bind(size=self.stats_label.setter('text_size'))
+        #  A MonteCarloBot for hints, created on demand, and the thread it
+        #  thinks on while a hint is on its way
+        self.bot = None
+        self.hint_thread = None
+        #  The field renderer is chosen in config, so it's not in kv file
+        if App.get_running_app().config.get('stackcity',
+                                            'renderer') == 'batched':
+            self.field = BatchedPlayingField()
+        else:
+            self.field = PlayingField()
+        if self.stats_label is not None:
+            self.add_widget(self.stats_label)
+        #  The first frame shows up right away, with nothing but the loading
+        #  label; the city is loaded and its field streamed in after it
         Clock.schedule_once(self.init_game)
 
+    def load_engine(self):
+        """
+        Restore the city from the journal or the autosave, if there is one,
+        or start a new one
+        :return:
+        """
+        field_size = App.get_running_app().config.getint('stackcity',
+                                                         'field_size')
+        journal_path = App.get_running_app().config.get('stackcity',
+                                                        'journal')
+        autosave_path = App.get_running_app().config.get('stackcity',
+                                                         'autosave')
+        if journal_path and os.path.exists(journal_path):
+            #  Picking up where the last game left off
+            self.engine = Journal(journal_path).restore()
+        else:
+            if autosave_path and os.path.exists(autosave_path):
+                self.engine = saves.load_city(autosave_path)
+            else:
+                self.engine = CityEngine(field_size=field_size)
+                self.engine.start_turn()
+            #  A journal that doesn't exist yet starts from whichever city
+            #  this is
+            if journal_path:
+                Journal(journal_path).start(self.engine)
+        if autosave_path:
+            self.engine.autosaver = Autosaver(autosave_path)
+        if self.stats_label is not None:
+            self.engine.instruments = Instruments()
+        self.cell_field = self.engine.cell_field
+        self.resources = self.engine.city_state.resources
+
     def init_game(self, stuff):
-        self.ids['field'].populate_field()
+        #  The class rule fills `ids` only after __init__, so the field is
+        #  attached here
+        self.ids['main_box'].add_widget(
+            self.field, index=len(self.ids['main_box'].children))
+        self.load_engine()
+        self.field.populate_field()
         self.bind(next_item=self.ids['next_item_box'].update_next_item)
-        self.bind(resources=self.ids['resource_box'].update_resources)
-        # Setting up citystate for buildings
-        Building.city_state = self.cell_field.city_state
-        self.start_turn()
+        self.resources.listeners.append(
+            self.ids['resource_box'].update_resources)
+        self.resources.publish(everything=True)
+        if self.field.loading < 1:
+            #  The rest of the field is built over the next frames
+            self.show_loading(self.field, self.field.loading)
+            self.field.bind(loading=self.show_loading)
+        else:
+            self.update_turn()
+
+    def show_loading(self, field, loading):
+        """
+        Show how much of the field is built, and the first turn once all of
+        it is. Later refreshes, eg when panning, don't show anything
+        :param field:
+        :param loading: a fraction
+        :return:
+        """
+        if loading < 1:
+            self.ids['next_item_label'].text = 'Loading field... {:.0%}'.format(
+                loading)
+        else:
+            self.field.unbind(loading=self.show_loading)
+            self.update_turn()
 
-    def start_turn(self):
-        self.next_item = self.next_item_factory.create_item()
+    def update_turn(self):
+        """
+        Show the new turn's item and resources
+        :return:
+        """
+        self.next_item = self.engine.next_item
         #  Updating next item label
         #  Widgetry gets updated by RightBlock's children
-        if isinstance(self.next_item, Building):
-            label = str(self.next_item)
-        elif isinstance(self.next_item, list):
-            # Assuming only ground comes in lists
-            label = name_ground_list(self.next_item)
+        label = describe_item(self.next_item)
+        if not self.engine.has_moves():
+            label += ' (no room for it)'
         self.ids['next_item_label'].text = label
-        #  Buildings, if any, make turn
-        for building in self.buildings:
-            building.make_turn()
-        #  Making resources available for subwidgets
-        self.resources = self.cell_field.city_state.resources
+        #  Only the resources that have changed get their labels redrawn
+        self.resources.publish()
+        if self.stats_label is not None:
+            latest = self.engine.instruments.latest
+            self.stats_label.text = str(latest) if latest else ''
+            self.stats_label.top = self.top
+
+    def reroll(self):
+        if self.engine is None:
+            return
+        self.engine.reroll()
+        self.update_turn()
+
+    def show_hint(self):
+        """
+        Ask the bot where to put the next item. It thinks on a thread for its
+        whole time budget, so the answer is shown when it comes
+        :return:
+        """
+        if self.engine is None or self.hint_thread is not None:
+            return
+        if self.bot is None:
+            self.bot = MonteCarloBot(time_budget=0.5)
+        #  The bot only gets a copy of the city, so the game can go on
+        moves = self.bot.candidates(self.engine)
+        save_data = saves.dumps(self.engine)
+        self.hint_thread = threading.Thread(
+            target=self.think, args=(moves, save_data, self.engine.turn),
+            daemon=True)
+        self.hint_thread.start()
+
+    def think(self, moves, save_data, turn):
+        """
+        Choose a move and pass it to the UI thread. Runs on hint_thread
+        :param moves:
+        :param save_data:
+        :param turn:
+        :return:
+        """
+        move = self.bot.best_move(save_data, moves)
+        Clock.schedule_once(lambda dt: self.show_move(move, turn))
+
+    def show_move(self, move, turn):
+        """
+        Show the bot's move, unless it's too late for it
+        :param move:
+        :param turn: the turn the move was chosen for
+        :return:
+        """
+        self.hint_thread = None
+        if self.engine.turn != turn:
+            return
+        action, number = move
+        if action == PLACE:
+            row, col = divmod(number, self.engine.field_size)
+            hint = 'Try row {}, column {}'.format(row + 1, col + 1)
+        else:
+            hint = 'Try a reroll'
+        self.ids['next_item_label'].text = '{} ({})'.format(
+            describe_item(self.next_item), hint)
+
+    def place_next_item(self, number):
+        """
+        Place the next item with its anchor on cell #number and start the
+        next turn. Return False if the engine rejected it
+        :param number:
+        :return:
+        """
+        item = self.next_item
+        changed = self.engine.play(number)
+        if changed is None:
+            return False
+        if isinstance(item, Building):
+            self.field.add_building(item, number)
+        else:
+            self.field.update_cells(changed)
+        self.update_turn()
+        return True
 
 
-class PlayingField(Widget):
+class PlayingField(StencilView):
     """
-    A grid of cells where the city is built
+    A grid of cells where the city is built.
+    The field may be much larger than the screen: it is panned by dragging
+    and zoomed with mouse wheel. Only the cells within the viewport get
+    widgets, which are recycled as the view moves and created over several
+    frames when there are many of them.
     """
+    #  Cell widget side at zoom 1, in pixels
+    cell_size = 32
+    #  Zoom factor for a single mouse wheel step
+    zoom_step = 1.25
+    #  Cell widgets are created over several frames, at most this many a
+    #  frame, so that neither startup nor zooming out stalls
+    widgets_per_frame = 300
+    #  Fraction of the visible part of the field that is built
+    loading = NumericProperty(1)
+
     def __init__(self, **kwargs):
         super(PlayingField, self).__init__(**kwargs)
         #  A placeholder value. It will be updated in self.populate_field
         self.field_size = 10
-        self.cells_grid = GridLayout(pos=self.pos, size=self.size,
-                                     cols=self.field_size, rows=self.field_size)
-        self.add_widget(self.cells_grid)
-        self.buildings_layer = FloatLayout(size=self.size, pos=self.pos)
+        self.cell_field = None
+        self.viewport = Viewport(self.field_size, self.cell_size)
+        self.tiles = None
+        #  The engine's Instruments, if it has any
+        self.instruments = None
+        #  FieldCell and BuildingWidget widgets of visible cells by cell number
+        self.cell_widgets = {}
+        self.building_widgets = {}
+        #  FieldCells that went out of view and can be reused
+        self.widget_pool = []
+        #  Numbers of visible cells that don't have widgets yet, last to be
+        #  built first
+        self.pending = []
+        self.visible_count = 0
+        self.cells_layer = Widget()
+        self.add_widget(self.cells_layer)
+        self.buildings_layer = Widget()
         self.add_widget(self.buildings_layer)
         self.bind(size=self.update_subwidgets)
         self.bind(pos=self.update_subwidgets)
 
-    def update_subwidgets(self, stuff, stuff2):
-        self.cells_grid.pos = self.pos
-        self.cells_grid.size = self.size
-        self.buildings_layer.pos = self.pos
-        self.buildings_layer.size = self.size
+    def update_subwidgets(self, *args):
+        self.viewport.resize(*self.size)
+        self.refresh_viewport()
 
     def populate_field(self):
         """
-        Fill the game field with empty terrain
+        Attach the field to the game's CellField and show its visible part
+        :return:
+        """
+        self.cell_field = App.get_running_app().root.cell_field
+        self.field_size = self.cell_field.field_size
+        self.viewport = Viewport(self.field_size, self.cell_size)
+        self.viewport.resize(*self.size)
+        self.tiles = tiles.TileResolver(self.cell_field)
+        self.instruments = App.get_running_app().root.engine.instruments
+        self.refresh_viewport()
+
+    def cell_pos(self, number):
+        """
+        Return window position of cell #number
+        :param number:
+        :return:
+        """
+        x, y = self.viewport.cell_origin(number)
+        return (self.x + x,
+                self.top - y - self.viewport.scaled_cell_size)
+
+    def refresh_viewport(self):
+        """
+        Create widgets for cells that came into view, recycle those that went
+        out of it and put all of them into place
+        :return:
+        """
+        if self.cell_field is None:
+            return
+        visible = set(self.viewport.visible_cells())
+        removed = [x for x in self.cell_widgets if x not in visible]
+        for number in removed:
+            widget = self.cell_widgets.pop(number)
+            self.cells_layer.remove_widget(widget)
+            self.widget_pool.append(widget)
+        removed_buildings = [x for x in self.building_widgets
+                             if x not in visible]
+        for number in removed_buildings:
+            self.buildings_layer.remove_widget(
+                self.building_widgets.pop(number))
+        if self.instruments is not None:
+            self.instruments.count('widgets_removed',
+                                   len(removed) + len(removed_buildings))
+        size = self.viewport.scaled_cell_size
+        self.pending = []
+        for number in visible:
+            widget = self.cell_widgets.get(number)
+            if widget is None:
+                self.pending.append(number)
+                continue
+            widget.size = size, size
+            widget.pos = self.cell_pos(number)
+            if number in self.building_widgets:
+                self.building_widgets[number].size = size, size
+                self.building_widgets[number].pos = widget.pos
+        #  Top rows first
+        self.pending.sort(reverse=True)
+        self.visible_count = len(visible)
+        self.build_pending()
+
+    def build_pending(self, *args):
+        """
+        Create widgets for some of the pending cells and schedule the rest
+        for the next frame
+        :return:
+        """
+        Clock.unschedule(self.build_pending)
+        size = self.viewport.scaled_cell_size
+        batch = self.pending[-self.widgets_per_frame:]
+        del self.pending[-self.widgets_per_frame:]
+        for number in batch:
+            widget = self.cell_widgets.get(number)
+            if widget is None:
+                if self.widget_pool:
+                    widget = self.widget_pool.pop()
+                    widget.cell = self.cell_field[number]
+                    widget.update_widget()
+                else:
+                    widget = FieldCell(self.cell_field[number])
+                    if self.instruments is not None:
+                        self.instruments.count('widgets_created')
+                self.cell_widgets[number] = widget
+                self.cells_layer.add_widget(widget)
+                building = self.cell_field.building_at(number)
+                if building is not None:
+                    self.add_building(building, number)
+            widget.size = size, size
+            widget.pos = self.cell_pos(number)
+            if number in self.building_widgets:
+                self.building_widgets[number].size = size, size
+                self.building_widgets[number].pos = widget.pos
+        if self.pending:
+            Clock.schedule_once(self.build_pending)
+        self.loading = 1 - len(self.pending)/max(1, self.visible_count)
+
+    def update_cells(self, numbers):
+        """
+        Redraw cells whose ground has changed, along with their neighbours.
+        Cells out of view are redrawn when they come into it
+        :param numbers:
+        :return:
+        """
+        self.tiles.mark_dirty(numbers)
+        resolved = self.tiles.resolve()
+        if self.instruments is not None:
+            self.instruments.count('tiles_updated', len(resolved))
+        for number, tile_key in resolved.items():
+            widget = self.get_cell_widget(number)
+            if widget is not None:
+                widget.update_widget(tile_key)
+
+    def get_cell_number_by_pos(self, pos):
+        """
+        Return the number of a cell on a given position, or None if the
+        position is outside the field.
+        :param pos:
         :return:
         """
-        self.field_size = App.get_running_app().root.cell_field.field_size
-        self.cells_grid.cols = self.field_size
-        self.cells_grid.rows = self.field_size
-        for x in range(self.field_size*self.field_size):
-            c = Cell()
-            App.get_running_app().root.cell_field.append(c)
-            self.cells_grid.add_widget(FieldCell(c))
+        if not self.collide_point(*pos):
+            return None
+        return self.viewport.cell_at(pos[0] - self.x, self.top - pos[1])
 
     def get_cell_by_pos(self, pos):
         """
@@ -103,22 +406,16 @@ class PlayingField(Widget):
         :param pos:
         :return:
         """
-        if self.collide_point(*pos):
-            for widget in self.cells_grid.children:
-                if isinstance(widget, FieldCell)and widget.collide_point(*pos):
-                        return widget
-        return None
+        return self.get_cell_widget(self.get_cell_number_by_pos(pos))
 
     def get_cell_widget(self, number):
         """
-        Get cell widget with a given ID. Return None if there is no such cell.
+        Get cell widget with a given ID. Return None if there is no such cell
+        or it is out of view.
         :param number:
         :return:
         """
-        for widget in self.cells_grid.children:
-            if isinstance(widget, FieldCell) and widget.cell.number == number:
-                return widget
-        return None
+        return self.cell_widgets.get(number)
 
     def get_cell_widgets(self, numbers):
         """
@@ -126,20 +423,282 @@ class PlayingField(Widget):
         :param numbers:
         :return:
         """
-        for widget in self.cells_grid.children:
-            if isinstance(widget, FieldCell) and widget.cell.number in numbers:
+        for number in numbers:
+            widget = self.get_cell_widget(number)
+            if widget is not None:
                 yield widget
 
     def add_building(self, building, number):
         """
-        Add a building widget to cell #number
+        Add a building widget to cell #number, if it is in view
         :param building:
         :param number:
         :return:
         """
-        building_widget = BuildingWidget(building,
-                                 pos=self.get_cell_widget(number).pos)
+        widget = self.get_cell_widget(number)
+        if widget is None:
+            return
+        building_widget = BuildingWidget(building, pos=widget.pos,
+                                         size=widget.size)
+        self.building_widgets[number] = building_widget
         self.buildings_layer.add_widget(building_widget)
+        if self.instruments is not None:
+            self.instruments.count('widgets_created')
+
+    def on_touch_down(self, touch):
+        if not self.collide_point(*touch.pos):
+            return False
+        if touch.is_mouse_scrolling:
+            if touch.button == 'scrollup':
+                factor = self.zoom_step
+            else:
+                factor = 1/self.zoom_step
+            self.viewport.zoom_at(factor, touch.x - self.x,
+                                  self.top - touch.y)
+            self.refresh_viewport()
+            return True
+        #  Cells show their tooltips, the rest of the drag pans the field
+        super(PlayingField, self).on_touch_down(touch)
+        touch.grab(self)
+        return True
+
+    def on_touch_move(self, touch):
+        if touch.grab_current is self:
+            self.viewport.pan(touch.dx, -touch.dy)
+            self.refresh_viewport()
+            return True
+        return super(PlayingField, self).on_touch_move(touch)
+
+    def on_touch_up(self, touch):
+        if touch.grab_current is self:
+            touch.ungrab(self)
+            return True
+        return super(PlayingField, self).on_touch_up(touch)
+
+
+class BatchedPlayingField(PlayingField):
+    """
+    A PlayingField that draws the field on its own canvas.
+    Instead of a widget per cell, ground is drawn with Meshes textured with
+    the sprite atlas (one Mesh per chunk of cells), and buildings are
+    Rectangles in a separate instruction group above it. With a packed
+    sprites.atlas, ground and buildings share a single GL texture. Only the
+    chunks in view are built, a few a frame. When cells change, only their
+    texture coordinates are rewritten and only their chunks are re-uploaded.
+    """
+    #  Chunk side, in cells. A Mesh cannot have more than 65535 vertices, and
+    #  every cell takes 4 of them
+    chunk_size = 64
+    #  Chunks are built over several frames, at most this many a frame
+    chunks_per_frame = 2
+
+    def __init__(self, **kwargs):
+        #  Skipping PlayingField.__init__, as there are no subwidgets here
+        super(PlayingField, self).__init__(**kwargs)
+        self.field_size = 10
+        self.cell_field = None
+        self.viewport = Viewport(self.field_size, self.cell_size)
+        self.tiles = None
+        self.instruments = None
+        self.cell_widgets = {}
+        self.pending = []
+        self.visible_count = 0
+        self.atlas = None
+        #  Texture coordinates by atlas key
+        self.tex_coords = {}
+        #  (chunk row, chunk col): [Mesh, vertices list, width in cells,
+        #  buildings InstructionGroup]
+        self.chunks = {}
+        self.tooltip = None
+        self.translate = Translate()
+        self.scale = Scale()
+        self.ground_group = InstructionGroup()
+        self.buildings_group = InstructionGroup()
+        self.canvas.add(PushMatrix())
+        self.canvas.add(self.translate)
+        self.canvas.add(self.scale)
+        #  Resetting the color left by canvas.before, so textures aren't tinted
+        self.canvas.add(Color(1, 1, 1, 1))
+        self.canvas.add(self.ground_group)
+        self.canvas.add(self.buildings_group)
+        self.canvas.add(PopMatrix())
+        self.bind(size=self.update_subwidgets)
+        self.bind(pos=self.update_subwidgets)
+
+    def populate_field(self):
+        """
+        Attach the field to the game's CellField and build meshes for its
+        visible part
+        :return:
+        """
+        self.atlas = textures.get_cache()
+        self.ground_group.clear()
+        self.buildings_group.clear()
+        self.chunks = {}
+        super(BatchedPlayingField, self).populate_field()
+
+    def refresh_viewport(self):
+        """
+        Build chunks that came into view, drop those that went out of it and
+        move the field into place
+        :return:
+        """
+        if self.cell_field is None:
+            return
+        #  Cell coordinates start at the lower left corner of the field
+        self.translate.xy = (self.x - self.viewport.offset_x,
+                             self.top + self.viewport.offset_y -
+                             self.viewport.field_extent)
+        self.scale.xyz = (self.viewport.zoom, self.viewport.zoom, 1)
+        first_row, last_row, first_col, last_col = \
+            self.viewport.visible_range()
+        visible = {(chunk_row, chunk_col)
+                   for chunk_row in range(first_row // self.chunk_size,
+                                          (last_row - 1) // self.chunk_size + 1)
+                   for chunk_col in range(first_col // self.chunk_size,
+                                          (last_col - 1) // self.chunk_size + 1)}
+        removed = [x for x in self.chunks if x not in visible]
+        for chunk in removed:
+            mesh, vertices, width, buildings = self.chunks.pop(chunk)
+            self.ground_group.remove(mesh)
+            self.buildings_group.remove(buildings)
+        if self.instruments is not None:
+            #  Chunk meshes stand in for widgets here
+            self.instruments.count('widgets_removed', len(removed))
+        #  Nearest to the top left corner last, as they are built first
+        self.pending = sorted((x for x in visible if x not in self.chunks),
+                              reverse=True)
+        self.visible_count = len(visible)
+        self.build_pending()
+
+    def build_pending(self, *args):
+        """
+        Build some of the pending chunks and schedule the rest for the next
+        frame
+        :return:
+        """
+        Clock.unschedule(self.build_pending)
+        batch = self.pending[-self.chunks_per_frame:]
+        del self.pending[-self.chunks_per_frame:]
+        for chunk in batch:
+            if chunk not in self.chunks:
+                self.build_chunk(*chunk)
+        if self.instruments is not None:
+            self.instruments.count('widgets_created', len(batch))
+        if self.pending:
+            Clock.schedule_once(self.build_pending)
+        self.loading = 1 - len(self.pending)/max(1, self.visible_count)
+
+    def get_tex_coords(self, tile_key):
+        if tile_key not in self.tex_coords:
+            self.tex_coords[tile_key] = self.atlas.get(tile_key).tex_coords
+        return self.tex_coords[tile_key]
+
+    def build_chunk(self, chunk_row, chunk_col):
+        """
+        Create a Mesh and building Rectangles for a given chunk
+        :param chunk_row:
+        :param chunk_col:
+        :return:
+        """
+        first_row = chunk_row*self.chunk_size
+        first_col = chunk_col*self.chunk_size
+        last_row = min(first_row + self.chunk_size, self.field_size)
+        last_col = min(first_col + self.chunk_size, self.field_size)
+        size = self.cell_size
+        vertices = []
+        indices = []
+        buildings = InstructionGroup()
+        for row in range(first_row, last_row):
+            y = (self.field_size - 1 - row)*size
+            for col in range(first_col, last_col):
+                number = row*self.field_size + col
+                x = col*size
+                u = self.get_tex_coords(tiles.tile_key(self.cell_field, number))
+                base = len(vertices)//4
+                #  Vertex format is x, y, u, v, counter-clockwise starting at
+                #  the lower left corner, same as in tex_coords
+                vertices.extend((x, y, u[0], u[1],
+                                 x + size, y, u[2], u[3],
+                                 x + size, y + size, u[4], u[5],
+                                 x, y + size, u[6], u[7]))
+                indices.extend((base, base + 1, base + 2,
+                                base + 2, base + 3, base))
+                building = self.cell_field.building_at(number)
+                if building is not None:
+                    buildings.add(self.make_building_rectangle(building,
+                                                               number))
+        #  All atlas regions share the same GL texture, so any of them will do
+        mesh = Mesh(vertices=vertices, indices=indices, mode='triangles',
+                    texture=self.atlas.get('empty'))
+        self.ground_group.add(mesh)
+        self.buildings_group.add(buildings)
+        self.chunks[(chunk_row, chunk_col)] = [mesh, vertices,
+                                               last_col - first_col, buildings]
+
+    def update_cells(self, numbers):
+        """
+        Redraw cells whose ground has changed, along with their neighbours.
+        Cells out of view are redrawn when their chunk is built
+        :param numbers:
+        :return:
+        """
+        self.tiles.mark_dirty(numbers)
+        dirty_chunks = set()
+        resolved = self.tiles.resolve()
+        if self.instruments is not None:
+            self.instruments.count('tiles_updated', len(resolved))
+        for number, tile_key in resolved.items():
+            row, col = divmod(number, self.field_size)
+            chunk = (row // self.chunk_size, col // self.chunk_size)
+            if chunk not in self.chunks:
+                continue
+            mesh, vertices, width, buildings = self.chunks[chunk]
+            index = (row % self.chunk_size)*width + col % self.chunk_size
+            u = self.get_tex_coords(tile_key)
+            for corner in range(4):
+                vertices[index*16 + corner*4 + 2] = u[corner*2]
+                vertices[index*16 + corner*4 + 3] = u[corner*2 + 1]
+            dirty_chunks.add(chunk)
+        for chunk in dirty_chunks:
+            mesh, vertices, width, buildings = self.chunks[chunk]
+            mesh.vertices = vertices
+
+    def make_building_rectangle(self, building, number):
+        row, col = divmod(number, self.field_size)
+        return Rectangle(texture=self.atlas.get(building.image_source),
+                         pos=(col*self.cell_size,
+                              (self.field_size - 1 - row)*self.cell_size),
+                         size=(self.cell_size, self.cell_size))
+
+    def add_building(self, building, number):
+        """
+        Draw a building on cell #number, if its chunk is in view
+        :param building:
+        :param number:
+        :return:
+        """
+        row, col = divmod(number, self.field_size)
+        chunk = (row // self.chunk_size, col // self.chunk_size)
+        if chunk in self.chunks:
+            self.chunks[chunk][3].add(
+                self.make_building_rectangle(building, number))
+
+    def on_touch_down(self, touch):
+        number = self.get_cell_number_by_pos(touch.pos)
+        if number is not None and self.tooltip is None and \
+                not touch.is_mouse_scrolling:
+            cell = self.cell_field[number]
+            self.tooltip = Label(text='{0} on {1} ground'.format(
+                cell.building, cell.ground.ground_type),
+                x=touch.x, y=touch.y-20, color=(1, 0, 0, 1))
+            self.add_widget(self.tooltip)
+            Clock.schedule_once(self.remove_tooltip, 1.2)
+        return super(BatchedPlayingField, self).on_touch_down(touch)
+
+    def remove_tooltip(self, dt):
+        self.remove_widget(self.tooltip)
+        self.tooltip = None
 
 
 class FieldCell(Widget):
@@ -150,31 +709,12 @@ class FieldCell(Widget):
     """
     cell = ObjectProperty()
     cell_text = StringProperty('')
-    images = {'military': 'atlas://grounds/military',
-              'living': 'atlas://grounds/living',
-              'infrastructure': 'atlas://grounds/infrastructure',
-              'water': 'atlas://grounds/water',
-              'empty': 'atlas://grounds/empty'}
 
     def __init__(self, cell, **kwargs):
         self.cell = cell
         super(FieldCell, self).__init__(**kwargs)
         self.update_widget()
         self.tooltip = None
-        self.updating = False # See FieldCell.update_widget
-
-    def accept_item(self, item):
-        # item = App.get_running_app().root.next_item
-        self.cell.add_item(item)
-        self.update_widget()
-        # Grounds get added to self, while Buildings have to be passed to
-        # PlayingField
-        if isinstance(item, Building):
-            self.cell.building = item
-            App.get_running_app().root.buildings.append(item)
-            App.get_running_app().root.ids['field'].\
-                add_building(item, self.cell.number)
-        return True
 
     def on_touch_down(self, touch):
         if self.collide_point(*touch.pos):
@@ -184,71 +724,32 @@ class FieldCell(Widget):
         self.tooltip = Label(text='{0} on {1} ground'.format(self.cell.building,
                                                  self.cell.ground.ground_type),
                              x=self.x, y=self.y-20, color=(1, 0, 0, 1))
-        self.parent.parent.add_widget(self.tooltip)
+        #  Remembering the field, as this widget may be recycled before the
+        #  tooltip is removed
+        self.tooltip_parent = self.parent.parent
+        self.tooltip_parent.add_widget(self.tooltip)
         Clock.schedule_once(self.remove_tooltip, 1.2)
 
     def remove_tooltip(self, dt):
-        self.parent.parent.remove_widget(self.tooltip)
+        self.tooltip_parent.remove_widget(self.tooltip)
 
-    def update_widget(self):
-        #  This boolean prevents this method being called when another instance
-        #  of it is running already, thus avoiding infinite recursion caused by
-        #  updating neighbours
-        self.updating = True
-        #  Later here will be some complex canvas magic
-        #  Changing source on the fly has the unnecessary overhead due to disk IO (?)
-        source = 'atlas://grounds/{0}'.format(self.cell.ground.ground_type)
-        if self.cell.number:
-            #  Neighborhood only checked for the tiles placed on map
-            if self.cell.ground.ground_type == 'water':
-                #  Currently only waterfronts are supported
-                source += self.get_neighbour_postfix()
-                for neighbour in App.get_running_app().root.ids['field'].get_cell_widgets(
-                    App.get_running_app().root.cell_field.get_neighbours(self.cell.number)):
-                    if not neighbour.updating:
-                        neighbour.update_widget()
-        # Source can be either newly created or changed by neighbours
-        if source != self.ids['cell_image'].source:
-            self.ids['cell_image'].source = source
-        self.updating = False
-
-    def get_neighbour_postfix(self):
-        """
-        Get a postfix for tile ID based on neighbours
-        This method is a sort of placeholder: no more than 2 borders per cell are
-        supported. This is mostly due to there being no 3-walled or 4-walled
-        tiles and is to be fixed sometime later. In addition, border choice is
-        dependent on position of neighbours: upper takes precedence over lower
-        and left -- over right. This, too, is to be fixed when I have more tiles
-        :param cell_field:
-        :param neighbours:
+    def update_widget(self, tile_key=None):
+        """
+        Redraw the cell.
+        :param tile_key: an atlas key to display. If None, it is computed
+        from the cell (see tiles.tile_key). Detached cells just show their
+        ground
         :return:
         """
-        # Take references purely for code readability
-        cell_field = App.get_running_app().root.cell_field
-        own_ground = self.cell.ground.ground_type
-        neighbours = cell_field.get_neighbours(self.cell.number)
-        if neighbours[1] and cell_field[neighbours[1]].ground.ground_type not in ('empty', own_ground):
-            if neighbours[3] and cell_field[neighbours[3]].ground.ground_type == cell_field[neighbours[1]].ground.ground_type:
-                return '_{0}_7'.format(cell_field[neighbours[1]].ground.ground_type)
-            elif neighbours[4] and cell_field[neighbours[4]].ground.ground_type == cell_field[neighbours[1]].ground.ground_type:
-                return '_{0}_9'.format(cell_field[neighbours[1]].ground.ground_type)
+        #  Textures come from the cache, so nothing is resolved or loaded here
+        if tile_key is None:
+            if self.cell.field is not None:
+                tile_key = tiles.tile_key(self.cell.field, self.cell.number)
             else:
-                return '_{0}_8'.format(cell_field[neighbours[1]].ground.ground_type)
-        elif neighbours[3] and cell_field[neighbours[3]].ground.ground_type not in ('empty', own_ground):
-            if neighbours[6] and cell_field[neighbours[6]].ground.ground_type == cell_field[neighbours[3]].ground.ground_type:
-                return '_{0}_1'.format(cell_field[neighbours[3]].ground.ground_type)
-            else:
-                return '_{0}_4'.format(cell_field[neighbours[3]].ground.ground_type)
-        elif neighbours[4] and cell_field[neighbours[4]].ground.ground_type not in ('empty', own_ground):
-            if neighbours[6] and cell_field[neighbours[6]].ground.ground_type == cell_field[neighbours[4]].ground.ground_type:
-                return '_{0}_3'.format(cell_field[neighbours[4]].ground.ground_type)
-            else:
-                return '_{0}_6'.format(cell_field[neighbours[4]].ground.ground_type)
-        elif neighbours[6] and cell_field[neighbours[6]].ground.ground_type not in ('empty', own_ground):
-            return '_{0}_2'.format(cell_field[neighbours[6]].ground.ground_type)
-        else:
-            return ''
+                tile_key = self.cell.ground.ground_type
+        texture = textures.get_cache().get(tile_key)
+        if texture is not self.ids['cell_image'].texture:
+            self.ids['cell_image'].texture = texture
 
 
 class BuildingWidget(Widget):
@@ -262,7 +763,8 @@ class BuildingWidget(Widget):
         self.update_widget()
 
     def update_widget(self):
-        self.ids['building_image'].source = self.building.image_source
+        self.ids['building_image'].texture = textures.get_cache().get(
+            self.building.image_source)
 
 
 #  Classes for stuff that can be dragged from the ItemMakerWidget to the field.
@@ -295,12 +797,10 @@ class GrabbableBuilding(BuildingWidget):
     def on_touch_up(self, touch):
         if touch.grab_current is self:
             accepted = False
-            acceptor = App.get_running_app().root.ids['field'].get_cell_by_pos(touch.pos)
-            if acceptor and acceptor.cell.can_accept(self.building):
-                self.building.get_placed(cell_field=App.get_running_app().root. \
-                                         cell_field, number=acceptor.cell.number)
-                acceptor.accept_item(self.building)
-                App.get_running_app().root.start_turn()
+            acceptor = App.get_running_app().root.field.\
+                get_cell_number_by_pos(touch.pos)
+            if acceptor is not None:
+                accepted = App.get_running_app().root.place_next_item(acceptor)
             if not accepted:
                 a = Animation(pos=self.starting_pos, duration=0.3)
                 a.start(self)
@@ -356,31 +856,14 @@ class GrabbableGroundGroup(Widget):
 
     def on_touch_up(self, touch):
         if touch.grab_current is self:
-            will_accept = True
-            for y in range(len(self.cells)):
-                for x in range(len(self.cells[y])):
-                    if self.cells[y][x]:
-                        acceptor = App.get_running_app().root.ids['field'].\
-                            get_cell_by_pos((
-                                self.center_x + self.offsets[y][x][0],
-                                self.center_y + self.offsets[y][x][1]
-                                ))
-                        # Either released out of field or in incorrect pos
-                        if not acceptor or not acceptor.cell.can_accept(self.cells[y][x]):
-                            will_accept = False
-                            break
-            if will_accept:
-                for y in range(len(self.cells)):
-                    for x in range(len(self.cells[y])):
-                        if self.cells[y][x]:
-                            acceptor = App.get_running_app().root.ids['field'].\
-                                get_cell_by_pos((
-                                self.center_x + self.offsets[y][x][0],
-                                self.center_y + self.offsets[y][x][1]
-                            ))
-                            acceptor.accept_item(self.cells[y][x])
-                App.get_running_app().root.start_turn()
-            else:
+            #  The middle cell is always at the group's center, the rest of
+            #  the block is laid out by the engine
+            acceptor = App.get_running_app().root.field.\
+                get_cell_number_by_pos(self.center)
+            # Either released out of field or in incorrect pos
+            will_accept = acceptor is not None and \
+                App.get_running_app().root.place_next_item(acceptor)
+            if not will_accept:
                 a = Animation(pos=self.starting_pos, duration=0.3)
                 a.start(self)
             touch.ungrab(self)
@@ -418,7 +901,8 @@ class ResourceView(BoxLayout):
     """
     def __init__(self, resource_icon='Coins.png', **kwargs):
         super(ResourceView, self).__init__(**kwargs)
-        self.ids['resource_icon'].source = resource_icon
+        self.ids['resource_icon'].texture = textures.get_cache().get(
+            resource_icon)
 
 
 class ResourceBox(BoxLayout):
@@ -433,9 +917,14 @@ class ResourceBox(BoxLayout):
                 resource_icon=resource_reference[x].icon_source)
             self.add_widget(self.resource_fields[x])
             
-    def update_resources(self, ins, val):
-        for x in val.keys():
-            self.resource_fields[x].ids['resource_count'].text = str(val[x])
+    def update_resources(self, changes):
+        """
+        Show new amounts of resources. Called by ResourceLedger.publish
+        :param changes: a dict of {resource name: amount}
+        :return:
+        """
+        for x in changes.keys():
+            self.resource_fields[x].ids['resource_count'].text = str(changes[x])
         
         
 class RightBlock(BoxLayout):
@@ -447,5 +936,24 @@ class StackCityApp(App):
     def __init__(self, **kwargs):
         super(StackCityApp, self).__init__(**kwargs)
 
+    def on_stop(self):
+        if self.root.hint_thread is not None:
+            self.root.hint_thread.join()
+        if self.root.bot is not None:
+            self.root.bot.close()
+        engine = self.root.engine
+        if engine is not None:
+            if engine.journal is not None:
+                engine.journal.close()
+            if engine.autosaver is not None:
+                engine.autosaver.close()
+
+    def build_config(self, config):
+        config.setdefaults('stackcity', {'field_size': 18,
+                                         'renderer': 'widgets',
+                                         'journal': '',
+                                         'autosave': '',
+                                         'profile': 0})
+
 if __name__ == '__main__':
     StackCityApp().run()
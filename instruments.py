@@ -0,0 +1,127 @@
+"""
+Opt-in per-turn instrumentation.
+When an Instruments object is attached to a CityEngine (engine.instruments),
+the engine times every building action (see scheduler.py) and the UI
+counts the autotile updates and widgets it makes. Counters are kept per
+turn, a turn lasting from one start_turn to the next, so that placements and
+UI updates caused by a player's move are counted in the turn they were made
+on.
+When nothing is attached, the engine and the UI only check for None.
+"""
+
+from collections import deque
+
+
+class TurnStats:
+    """
+    Counters of a single turn
+    """
+    def __init__(self, turn, resources):
+        self.turn = turn
+        #  Seconds spent in building actions and number of actions, by
+        #  building class. Idle buildings and steady production don't count
+        self.make_turn_time = {}
+        self.make_turn_calls = {}
+        #  UI counters
+        self.tiles_updated = 0
+        self.widgets_created = 0
+        self.widgets_removed = 0
+        #  Resources at the start of the turn. Deltas are computed when the
+        #  turn is over
+        self.start_resources = dict(resources)
+        self.resource_deltas = {}
+
+    def count_action(self, building, elapsed):
+        name = type(building).__name__
+        self.make_turn_time[name] = self.make_turn_time.get(name, 0.0) + \
+            elapsed
+        self.make_turn_calls[name] = self.make_turn_calls.get(name, 0) + 1
+
+    @property
+    def make_turn_total(self):
+        return sum(self.make_turn_time.values())
+
+    def finish(self, resources):
+        self.resource_deltas = {name: resources[name] -
+                                self.start_resources.get(name, 0)
+                                for name in resources}
+
+    def as_dict(self):
+        return {'turn': self.turn,
+                'make_turn_time': dict(self.make_turn_time),
+                'make_turn_calls': dict(self.make_turn_calls),
+                'tiles_updated': self.tiles_updated,
+                'widgets_created': self.widgets_created,
+                'widgets_removed': self.widgets_removed,
+                'resource_deltas': dict(self.resource_deltas)}
+
+    def __str__(self):
+        lines = ['Turn {}: make_turn {:.2f} ms'.format(
+            self.turn, self.make_turn_total*1000)]
+        for name in sorted(self.make_turn_time):
+            lines.append('  {}: {} x, {:.2f} ms'.format(
+                name, self.make_turn_calls[name],
+                self.make_turn_time[name]*1000))
+        lines.append('Tiles {}, widgets +{} -{}'.format(
+            self.tiles_updated, self.widgets_created, self.widgets_removed))
+        lines.append(', '.join('{} {:+}'.format(name, delta)
+                               for name, delta in
+                               sorted(self.resource_deltas.items())))
+        return '\n'.join(lines)
+
+
+class Instruments:
+    """
+    Per-turn counters of an engine, with a history of the last few turns
+    """
+    def __init__(self, history_size=100):
+        #  Finished turns, oldest first
+        self.history = deque(maxlen=history_size)
+        self.current = None
+
+    def make_turns(self, engine):
+        """
+        Finish the current turn's stats, start the next turn's ones and let
+        the buildings make their turn, timing each action. Called by
+        CityEngine.start_turn in place of advancing the scheduler itself
+        :param engine:
+        :return:
+        """
+        resources = engine.city_state.resources
+        if self.current is not None:
+            self.current.finish(resources)
+            self.history.append(self.current)
+        #  engine.turn is incremented after buildings are done
+        self.current = TurnStats(engine.turn + 1, resources)
+        engine.scheduler.advance(1, stats=self.current)
+
+    def count(self, counter, number=1):
+        """
+        Add to one of the current turn's UI counters
+        :param counter: 'tiles_updated', 'widgets_created' or
+        'widgets_removed'
+        :param number:
+        :return:
+        """
+        if self.current is not None:
+            setattr(self.current, counter,
+                    getattr(self.current, counter) + number)
+
+    @property
+    def latest(self):
+        """
+        The last finished turn's stats, or None
+        :return:
+        """
+        return self.history[-1] if self.history else None
+
+    def totals(self):
+        """
+        Return make_turn time by building class summed over the history
+        :return:
+        """
+        r = {}
+        for stats in self.history:
+            for name, elapsed in stats.make_turn_time.items():
+                r[name] = r.get(name, 0.0) + elapsed
+        return r
@@ -0,0 +1,165 @@
+"""
+An append-only journal of player actions.
+Every placement and reroll is appended to the journal as a small fixed-size
+record, and every so often the whole city is saved as a snapshot next to it.
+Restoring a city means loading the latest snapshot and replaying the journal
+records made after it through the engine. Since the item factory's RNG state
+is a part of the snapshot, replay is deterministic.
+"""
+
+import os
+import struct
+
+from cells import StackCityException
+import saves
+
+MAGIC = b'SCJL'
+VERSION = 1
+
+#  Magic, version
+header_format = struct.Struct('<4sH')
+#  Action, turn on which the action was made, cell number (or number of
+#  turns, for fast-forwarding)
+record_format = struct.Struct('<BII')
+
+PLACE = 1
+REROLL = 2
+FAST_FORWARD = 3
+
+
+class Journal:
+    """
+    A journal file and its snapshot.
+    The snapshot is stored in `path` + '.snapshot' and is replaced atomically
+    """
+    def __init__(self, path, snapshot_interval=100, sync=False):
+        self.path = path
+        self.snapshot_path = path + '.snapshot'
+        #  Take a snapshot every this many turns
+        self.snapshot_interval = snapshot_interval
+        #  Whether to fsync every record. Without it, records survive the
+        #  game crashing, but not necessarily the OS doing so
+        self.sync = sync
+        self.file = None
+
+    def start(self, engine):
+        """
+        Start a new journal for an engine, overwriting the old one if any
+        :param engine:
+        :return:
+        """
+        self.save_snapshot(engine)
+        self.file = open(self.path, 'wb')
+        self.file.write(header_format.pack(MAGIC, VERSION))
+        self.file.flush()
+        engine.journal = self
+
+    def restore(self):
+        """
+        Load the latest snapshot, replay the journal tail and attach the
+        journal to the resulting engine
+        :return: a CityEngine
+        """
+        engine = saves.load_city(self.snapshot_path)
+        with open(self.path, 'rb') as file:
+            magic, version = header_format.unpack(
+                file.read(header_format.size))
+            if magic != MAGIC or version != VERSION:
+                raise StackCityException('Not a StackCity journal')
+            file.seek(0, os.SEEK_END)
+            #  A record may have been cut short by a crash
+            record_count = (file.tell() - header_format.size) // \
+                record_format.size
+            first = self.find_record(file, record_count, engine.turn)
+            file.seek(header_format.size + first*record_format.size)
+            for x in range(first, record_count):
+                action, turn, number = record_format.unpack(
+                    file.read(record_format.size))
+                self.replay(engine, action, turn, number)
+        self.file = open(self.path, 'r+b')
+        self.file.truncate(header_format.size +
+                           record_count*record_format.size)
+        self.file.seek(0, os.SEEK_END)
+        engine.journal = self
+        return engine
+
+    @staticmethod
+    def find_record(file, record_count, turn):
+        """
+        Return the index of the first record made on `turn` or later.
+        Records are sorted by turn, so it's a binary search
+        :param file:
+        :param record_count:
+        :param turn:
+        :return:
+        """
+        low, high = 0, record_count
+        while low < high:
+            middle = (low + high)//2
+            file.seek(header_format.size + middle*record_format.size)
+            action, record_turn, number = record_format.unpack(
+                file.read(record_format.size))
+            if record_turn < turn:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    @staticmethod
+    def replay(engine, action, turn, number):
+        if turn != engine.turn:
+            raise StackCityException(
+                'Journal record for turn {} replayed on turn {}'.format(
+                    turn, engine.turn))
+        if action == PLACE:
+            if not engine.play(number):
+                raise StackCityException(
+                    'Journal placement on turn {} was rejected'.format(turn))
+        elif action == REROLL:
+            engine.reroll()
+        elif action == FAST_FORWARD:
+            engine.fast_forward(number)
+        else:
+            raise StackCityException('Unknown journal action')
+
+    def record(self, engine, action, turn, number=0):
+        """
+        Append an action made on `turn` to the journal. Called by the engine
+        after the action is complete
+        :param engine:
+        :param action:
+        :param turn:
+        :param number:
+        :return:
+        """
+        self.file.write(record_format.pack(action, turn, number))
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+        #  Fast-forwarding may jump over a multiple of the interval
+        if engine.turn // self.snapshot_interval > \
+                turn // self.snapshot_interval:
+            self.save_snapshot(engine)
+
+    def record_placement(self, engine, turn, number):
+        self.record(engine, PLACE, turn, number)
+
+    def record_reroll(self, engine, turn):
+        self.record(engine, REROLL, turn)
+
+    def record_fast_forward(self, engine, turn, turns):
+        self.record(engine, FAST_FORWARD, turn, turns)
+
+    def save_snapshot(self, engine):
+        """
+        Save the engine to a temporary file and then put it in place of the
+        old snapshot
+        :param engine:
+        :return:
+        """
+        saves.replace_file(saves.take_snapshot(engine), self.snapshot_path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
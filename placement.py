@@ -0,0 +1,109 @@
+"""
+Finding every legal position for an item.
+Rows of the field are turned into "byte-boards": Python ints with one byte
+per cell, which is 1 if the item can go on that cell and 0 otherwise. Bytes
+rather than bits let a whole row be built with a single bytes.translate call.
+A block fits at an anchor if, for every cell of its shape, the board row at
+that cell's row offset has a 1 at that cell's column offset. Column offsets
+are byte shifts, so a whole row of anchors is checked with a handful of big
+int operations, whatever the field size.
+"""
+
+from cells import Building, ground_type_list
+from shapes import GroundBlock, Shape
+
+
+class PlacementFinder:
+    """
+    Legal placement queries for a CellField
+    """
+    def __init__(self, cell_field):
+        self.cell_field = cell_field
+        size = cell_field.field_size
+        #  All cells of a row set
+        self.full_row = int.from_bytes(b'\x01'*size, 'little')
+        #  bytes.translate tables for the built flags
+        self.free_table = bytes([1] + [0]*255)
+
+    def acceptance_rows(self, acceptable_ground, free_only=False):
+        """
+        Return a list of byte-boards, one per field row, with ones on cells
+        whose ground is in `acceptable_ground`
+        :param acceptable_ground:
+        :param free_only: if True, built cells are excluded
+        :return:
+        """
+        table = bytes(1 if code < len(ground_type_list) and
+                      ground_type_list[code] in acceptable_ground else 0
+                      for code in range(256))
+        size = self.cell_field.field_size
+        grounds = self.cell_field.grounds
+        built = self.cell_field.built
+        r = []
+        for start in range(0, size*size, size):
+            row = int.from_bytes(grounds[start:start+size].translate(table),
+                                 'little')
+            if free_only and row:
+                row &= int.from_bytes(
+                    built[start:start+size].translate(self.free_table),
+                    'little')
+            r.append(row)
+        return r
+
+    def anchor_rows(self, item):
+        """
+        Return a list of byte-boards with ones on legal anchors for an item
+        :param item:
+        :return:
+        """
+        if isinstance(item, Building):
+            return self.acceptance_rows(item.acceptable_ground, free_only=True)
+        shape = item.shape if isinstance(item, GroundBlock) else Shape(item)
+        #  Blocks are made of the same ground everywhere
+        ground = next(x for row in item for x in row if x)
+        rows = self.acceptance_rows(ground.acceptable_ground)
+        size = self.cell_field.field_size
+        r = []
+        for anchor_row in range(size):
+            board = self.full_row
+            for row_offset, col_offset in shape.offsets:
+                row = anchor_row + row_offset
+                if not 0 <= row < size:
+                    board = 0
+                    break
+                if col_offset > 0:
+                    board &= rows[row] >> 8*col_offset
+                elif col_offset < 0:
+                    board &= (rows[row] << -8*col_offset) & self.full_row
+                else:
+                    board &= rows[row]
+                if not board:
+                    break
+            r.append(board)
+        return r
+
+    def legal_anchors(self, item):
+        """
+        Return a list of all cell numbers where an item can be placed
+        :param item:
+        :return:
+        """
+        size = self.cell_field.field_size
+        r = []
+        for row, board in enumerate(self.anchor_rows(item)):
+            if not board:
+                continue
+            data = board.to_bytes(size, 'little')
+            col = data.find(1)
+            while col >= 0:
+                r.append(row*size + col)
+                col = data.find(1, col + 1)
+        return r
+
+    def has_legal_anchor(self, item):
+        """
+        Return True if an item can be placed anywhere at all
+        :param item:
+        :return:
+        """
+        return any(self.anchor_rows(item))
@@ -0,0 +1,478 @@
+"""
+Saving and loading cities.
+A save is a compact binary file: a header, a table of sections and the
+sections themselves, so any part of it can be read from a memory-mapped file
+without parsing the rest. Field arrays are stored exactly as CellField keeps
+them, which makes loading them a single copy. Buildings are stored as
+fixed-size records and only become objects when they are first needed.
+All numbers are little-endian. Strings (city name, resource names, building
+classes, names and images) are stored once in a string table and referred
+to by their index in it.
+"""
+
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections import namedtuple
+
+from cells import Building, StackCityException, ground_type_list
+from buildings import building_classes
+from engine import CityEngine
+from shapes import block_from_rows
+
+MAGIC = b'SCTY'
+VERSION = 1
+
+#  Magic, version, field size, turn, building count, section count
+header_format = struct.Struct('<4sHIIII')
+#  Tag, offset, length
+section_format = struct.Struct('<4sQQ')
+#  Class, name and image string IDs, acceptable ground mask, cell number and
+#  up to four saved attributes (see Building.saved_attributes)
+building_format = struct.Struct('<HHHBxI4i')
+#  Random.getstate() is (version, 625 ints, gauss_next)
+rng_format = struct.Struct('<B625I?d')
+string_length_format = struct.Struct('<H')
+#  City name ID, resource count; followed by (name ID, amount) pairs
+state_format = struct.Struct('<HH')
+resource_format = struct.Struct('<Hq')
+
+#  Cell number of a building that is not on the field (eg the next item)
+NOT_PLACED = 0xFFFFFFFF
+#  Ground code of an empty spot in a ground block
+NO_GROUND = 0xFF
+
+#  A copy of everything that goes into a save. It doesn't share any mutable
+#  state with the engine, so it can be written while the game goes on.
+#  `buildings` is a list of building records, ie tuples of (class name, name,
+#  image source, acceptable ground, cell number, saved attribute values);
+#  `next_item` is None, ('building', record) or ('block', rows of ground type
+#  names or Nones)
+CitySnapshot = namedtuple('CitySnapshot',
+                          'name resources field_size turn grounds bonuses '
+                          'bonus_types built building_ids buildings '
+                          'rng_state next_item')
+
+
+def building_record(building):
+    """
+    Return a save record for a building
+    :param building:
+    :return:
+    """
+    return (type(building).__name__, building.name, building.image_source,
+            tuple(building.acceptable_ground), building.number,
+            tuple(getattr(building, x) for x in building.saved_attributes))
+
+
+def take_snapshot(engine, buildings=None, cells=True):
+    """
+    Copy the state of a CityEngine into a CitySnapshot
+    :param engine:
+    :param buildings: building records to use instead of settling and
+    recording every building, eg ones kept up to date by autosave.Autosaver
+    :param cells: whether to copy the field arrays. Without them, `grounds`,
+    `bonuses`, `built` and `building_ids` are None
+    :return:
+    """
+    cell_field = engine.cell_field
+    if buildings is None:
+        engine.settle()
+        buildings = [building_record(x) for x in cell_field.buildings]
+    if isinstance(engine.next_item, Building):
+        next_item = ('building', building_record(engine.next_item))
+    elif engine.next_item is not None:
+        next_item = ('block', [[x.ground_type if x else None for x in row]
+                               for row in engine.next_item])
+    else:
+        next_item = None
+    return CitySnapshot(
+        name=engine.city_state.name,
+        resources=dict(engine.city_state.resources),
+        field_size=cell_field.field_size,
+        turn=engine.turn,
+        grounds=bytes(cell_field.grounds) if cells else None,
+        bonuses=bytes(cell_field.bonuses) if cells else None,
+        bonus_types=list(cell_field.bonus_types),
+        built=bytes(cell_field.built) if cells else None,
+        building_ids=array_bytes(cell_field.building_ids) if cells else None,
+        buildings=buildings,
+        rng_state=engine.next_item_factory.random.getstate(),
+        next_item=next_item)
+
+
+def array_bytes(a):
+    """
+    Return the contents of an array as little-endian bytes
+    :param a:
+    :return:
+    """
+    if sys.byteorder == 'big':
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+
+class StringTable:
+    """
+    A list of unique strings, used while writing a save
+    """
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def __getitem__(self, string):
+        if string not in self.ids:
+            self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return self.ids[string]
+
+    def encode(self):
+        r = bytearray(string_length_format.pack(len(self.strings)))
+        for string in self.strings:
+            data = string.encode('utf-8')
+            r += string_length_format.pack(len(data))
+            r += data
+        return bytes(r)
+
+
+def _encode_building(record, strings):
+    class_name, name, image_source, acceptable_ground, number, attributes = \
+        record
+    ground_mask = 0
+    for code, ground_type in enumerate(ground_type_list):
+        if ground_type in acceptable_ground:
+            ground_mask |= 1 << code
+    attributes = tuple(attributes) + (0,)*(4 - len(attributes))
+    return building_format.pack(
+        strings[class_name], strings[name], strings[image_source],
+        ground_mask, NOT_PLACED if number is None else number, *attributes)
+
+
+def _encode_next_item(next_item, strings):
+    if next_item is None:
+        return b'\x00'
+    kind, data = next_item
+    if kind == 'building':
+        return b'\x01' + _encode_building(data, strings)
+    r = bytearray((2, len(data)))
+    for row in data:
+        r.append(len(row))
+        r.extend(NO_GROUND if x is None else ground_type_list.index(x)
+                 for x in row)
+    return bytes(r)
+
+
+def write_snapshot(snapshot, file):
+    """
+    Write a CitySnapshot to a binary file object
+    :param snapshot:
+    :param file:
+    :return:
+    """
+    strings = StringTable()
+    state = bytearray(state_format.pack(strings[snapshot.name],
+                                        len(snapshot.resources)))
+    for name, amount in snapshot.resources.items():
+        state += resource_format.pack(strings[name], amount)
+    bonus_types = bytearray(string_length_format.pack(
+        len(snapshot.bonus_types) - 1))
+    for bonus in snapshot.bonus_types[1:]:
+        bonus_types += string_length_format.pack(strings[bonus])
+    buildings = b''.join(_encode_building(x, strings)
+                         for x in snapshot.buildings)
+    version, internal_state, gauss_next = snapshot.rng_state
+    rng = rng_format.pack(version, *internal_state, gauss_next is not None,
+                          gauss_next or 0.0)
+    next_item = _encode_next_item(snapshot.next_item, strings)
+    sections = [(b'STAT', bytes(state)),
+                (b'GRND', snapshot.grounds),
+                (b'BONS', snapshot.bonuses),
+                (b'BTYP', bytes(bonus_types)),
+                (b'BLT ', snapshot.built),
+                (b'BIDS', snapshot.building_ids),
+                (b'BLDG', buildings),
+                (b'RAND', rng),
+                (b'NEXT', next_item),
+                (b'STRS', strings.encode())]
+    file.write(header_format.pack(MAGIC, VERSION, snapshot.field_size,
+                                  snapshot.turn, len(snapshot.buildings),
+                                  len(sections)))
+    offset = header_format.size + section_format.size*len(sections)
+    for tag, data in sections:
+        file.write(section_format.pack(tag, offset, len(data)))
+        offset += len(data)
+    for tag, data in sections:
+        file.write(data)
+
+
+def save_city(engine, path):
+    """
+    Save a CityEngine to a file
+    :param engine:
+    :param path:
+    :return:
+    """
+    with open(path, 'wb') as file:
+        write_snapshot(take_snapshot(engine), file)
+
+
+def replace_file(snapshot, path):
+    """
+    Write a CitySnapshot to a temporary file and then put it in place of
+    `path`, so that a crash never leaves a half-written save behind
+    :param snapshot:
+    :param path:
+    :return:
+    """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        write_snapshot(snapshot, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+def dumps(engine):
+    """
+    Return a save of a CityEngine as bytes
+    :param engine:
+    :return:
+    """
+    chunks = []
+    write_snapshot(take_snapshot(engine), _ChunkWriter(chunks))
+    return b''.join(chunks)
+
+
+class _ChunkWriter:
+    def __init__(self, chunks):
+        self.write = chunks.append
+
+
+class SaveReader:
+    """
+    A parsed save header over a buffer (bytes or an mmap).
+    Sections are only decoded when asked for.
+    Use it as a context manager: an mmap can't be closed while views of it
+    exist, and a traceback would keep them alive, so they are all released
+    on exit
+    """
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+        #  Views of sections handed out, to be released with the buffer
+        self.views = []
+        try:
+            if len(self.buffer) < header_format.size:
+                raise StackCityException('Not a StackCity save')
+            magic, version, self.field_size, self.turn, \
+                self.building_count, section_count = \
+                header_format.unpack_from(self.buffer, 0)
+            if magic != MAGIC:
+                raise StackCityException('Not a StackCity save')
+            if version != VERSION:
+                raise StackCityException(
+                    'Unsupported save version {}'.format(version))
+            if len(self.buffer) < header_format.size + \
+                    section_count*section_format.size:
+                raise StackCityException('Truncated save')
+            self.sections = {}
+            for x in range(section_count):
+                tag, offset, length = section_format.unpack_from(
+                    self.buffer, header_format.size + x*section_format.size)
+                if offset + length > len(self.buffer):
+                    raise StackCityException('Truncated save')
+                self.sections[tag] = (offset, length)
+            self.strings = self.read_strings()
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Release the buffer and every section view
+        :return:
+        """
+        for view in self.views:
+            view.release()
+        self.views = []
+        self.buffer.release()
+
+    def section(self, tag):
+        offset, length = self.sections[tag]
+        view = self.buffer[offset:offset+length]
+        self.views.append(view)
+        return view
+
+    def read_strings(self):
+        data = self.section(b'STRS')
+        count, = string_length_format.unpack_from(data, 0)
+        offset = string_length_format.size
+        r = []
+        for x in range(count):
+            length, = string_length_format.unpack_from(data, offset)
+            offset += string_length_format.size
+            r.append(bytes(data[offset:offset+length]).decode('utf-8'))
+            offset += length
+        return r
+
+    def read_state(self):
+        """
+        Return city name and a dict of resources
+        :return:
+        """
+        data = self.section(b'STAT')
+        name_id, count = state_format.unpack_from(data, 0)
+        resources = {}
+        for x in range(count):
+            resource_id, amount = resource_format.unpack_from(
+                data, state_format.size + x*resource_format.size)
+            resources[self.strings[resource_id]] = amount
+        return self.strings[name_id], resources
+
+    def read_bonus_types(self):
+        data = self.section(b'BTYP')
+        count, = string_length_format.unpack_from(data, 0)
+        return [None] + [self.strings[string_length_format.unpack_from(
+            data, string_length_format.size*(x + 1))[0]]
+            for x in range(count)]
+
+    def read_building_ids(self):
+        r = array('i')
+        r.frombytes(self.section(b'BIDS'))
+        if sys.byteorder == 'big':
+            r.byteswap()
+        return r
+
+    def read_rng_state(self):
+        values = rng_format.unpack_from(self.section(b'RAND'), 0)
+        gauss_next = values[-1] if values[-2] else None
+        return values[0], tuple(values[1:626]), gauss_next
+
+    def read_next_item(self):
+        #  A copy, as it's small and sliced further
+        data = bytes(self.section(b'NEXT'))
+        if data[0] == 1:
+            return decode_building(data[1:], 0, self.strings)
+        elif data[0] == 2:
+            rows = []
+            offset = 2
+            for y in range(data[1]):
+                length = data[offset]
+                rows.append([None if x == NO_GROUND else ground_type_list[x]
+                             for x in data[offset+1:offset+1+length]])
+                offset += length + 1
+            return block_from_rows(rows)
+        return None
+
+
+def decode_building(records, index, strings, cell_field=None):
+    """
+    Create a building from record #index of a buffer of building records
+    :param records:
+    :param index:
+    :param strings:
+    :param cell_field:
+    :return:
+    """
+    class_id, name_id, image_id, ground_mask, number, *attributes = \
+        building_format.unpack_from(records, index*building_format.size)
+    cls = building_classes[strings[class_id]]
+    building = cls(name=strings[name_id], image_source=strings[image_id],
+                   acceptable_ground=[x for code, x in
+                                      enumerate(ground_type_list)
+                                      if ground_mask & 1 << code])
+    for attribute, value in zip(cls.saved_attributes, attributes):
+        setattr(building, attribute, value)
+    if number != NOT_PLACED:
+        building.cell_field = cell_field
+        building.number = number
+        building.building_id = index
+    return building
+
+
+class BuildingTable:
+    """
+    A list of buildings that are created from save records on first access.
+    It is used as CellField.buildings for loaded cities
+    """
+    def __init__(self, records, strings, cell_field):
+        self.records = bytes(records)
+        self.strings = strings
+        self.cell_field = cell_field
+        self.buildings = [None]*(len(self.records)//building_format.size)
+        #  How many records are not decoded yet
+        self.pending = len(self.buildings)
+
+    def __len__(self):
+        return len(self.buildings)
+
+    def __getitem__(self, index):
+        building = self.buildings[index]
+        if building is None:
+            building = decode_building(self.records, index, self.strings,
+                                       self.cell_field)
+            self.buildings[index] = building
+            self.pending -= 1
+        return building
+
+    def __iter__(self):
+        if self.pending:
+            for index in range(len(self.buildings)):
+                self[index]
+        return iter(self.buildings)
+
+    def append(self, building):
+        self.buildings.append(building)
+
+
+def read_city(buffer):
+    """
+    Create a CityEngine from a save in a buffer
+    :param buffer:
+    :return:
+    """
+    with SaveReader(buffer) as reader:
+        name, resources = reader.read_state()
+        engine = CityEngine(field_size=reader.field_size, city_name=name)
+        engine.turn = reader.turn
+        engine.city_state.resources.update(resources)
+        cell_field = engine.cell_field
+        cell_field.grounds[:] = reader.section(b'GRND')
+        cell_field.bonuses[:] = reader.section(b'BONS')
+        cell_field.built[:] = reader.section(b'BLT ')
+        cell_field.bonus_types = reader.read_bonus_types()
+        cell_field.building_ids = reader.read_building_ids()
+        cell_field.buildings = BuildingTable(reader.section(b'BLDG'),
+                                             reader.strings, cell_field)
+        engine.buildings = cell_field.buildings
+        engine.next_item_factory.random.setstate(reader.read_rng_state())
+        engine.next_item = reader.read_next_item()
+    return engine
+
+
+def load_city(path):
+    """
+    Load a CityEngine from a save file
+    :param path:
+    :return:
+    """
+    with open(path, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return read_city(buffer)
+
+
+def loads(data):
+    """
+    Create a CityEngine from bytes returned by `dumps`
+    :param data:
+    :return:
+    """
+    return read_city(data)
@@ -0,0 +1,136 @@
+"""
+Event-driven turn processing.
+Instead of calling make_turn on every building every turn, buildings tell
+the scheduler how they behave (see Building.schedule):
+ - steady production: resources a building produces every turn no matter
+   what, like a staffed workshop. These are summed into per-turn rates, so
+   a thousand fishing boats cost a single addition per resource;
+ - events: turns on which a building needs to act, like a Dwelling getting
+   its next dweller. Events go to a heap, and buildings with no events
+   coming, like a full Dwelling, cost nothing at all.
+A building that doesn't know better acts every turn, which is what make_turn
+used to do.
+Advancing N turns costs O(events) rather than O(N x buildings).
+"""
+
+import heapq
+from time import perf_counter
+
+from city import resource_names
+
+
+class TurnScheduler:
+    """
+    Schedules the buildings of a CellField.
+    The scheduler's clock is the engine's turn: buildings are in sync with
+    turn `turn`, which is the last one processed
+    """
+    def __init__(self, cell_field, turn=0):
+        self.cell_field = cell_field
+        self.turn = turn
+        #  Resources produced every turn, by slot
+        self.rates = [0]*len(resource_names)
+        #  (turn, building_id), soonest first. Entries whose turn differs
+        #  from the building's entry in `due` are outdated and skipped
+        self.events = []
+        #  Turn of the next event by building_id
+        self.due = {}
+        #  Steady production by building_id, to be withdrawn on reschedule
+        self.steady = {}
+        #  A workforce.WorkforceAllocator to staff workshops as workers are
+        #  born, if any
+        self.allocator = None
+        #  A set to add the building_id of every rescheduled building to, or
+        #  None. Every change of a building's state ends with a reschedule
+        self.changed = None
+        for building in cell_field.buildings:
+            self.add(building)
+
+    def add(self, building):
+        """
+        Start scheduling a building that has just been placed
+        :param building:
+        :return:
+        """
+        self.reschedule(building)
+        #  Neighbours may depend on it, eg Dwellings grow faster in groups
+        table = self.cell_field.neighbour_table
+        base = building.number*8
+        for cell in table[base:base+8]:
+            if cell >= 0:
+                neighbour = self.cell_field.building_at(cell)
+                if neighbour is not None and neighbour is not building:
+                    self.reschedule(neighbour)
+
+    def reschedule(self, building):
+        """
+        Ask a building how it behaves from now on
+        :param building:
+        :return:
+        """
+        building_id = building.building_id
+        if self.changed is not None:
+            self.changed.add(building_id)
+        for index, amount in self.steady.pop(building_id, ()):
+            self.rates[index] -= amount
+        next_turn, steady = building.schedule(self.turn)
+        if steady:
+            self.steady[building_id] = steady
+            for index, amount in steady:
+                self.rates[index] += amount
+        if next_turn is None:
+            self.due.pop(building_id, None)
+        else:
+            self.due[building_id] = next_turn
+            heapq.heappush(self.events, (next_turn, building_id))
+
+    def advance(self, turns=1, stats=None):
+        """
+        Process `turns` turns.
+        Within a turn, steady production comes first and then the buildings
+        act in the order they were placed in
+        :param turns:
+        :param stats: an instruments.TurnStats to time building actions in
+        :return:
+        """
+        target = self.turn + turns
+        amounts = self.cell_field.city_state.resources.amounts
+        #  The last turn for which steady production was credited
+        credited = self.turn
+        events = self.events
+        buildings = self.cell_field.buildings
+        while events and events[0][0] <= target:
+            turn, building_id = heapq.heappop(events)
+            if self.due.get(building_id) != turn:
+                continue
+            if turn > credited:
+                for index, rate in enumerate(self.rates):
+                    amounts[index] += rate*(turn - credited)
+                credited = turn
+            self.turn = turn
+            building = buildings[building_id]
+            if stats is None:
+                building.act(turn)
+            else:
+                start = perf_counter()
+                building.act(turn)
+                stats.count_action(building, perf_counter() - start)
+            self.reschedule(building)
+            #  Workshops staffed now start working next turn
+            if self.allocator is not None and self.allocator.waiting:
+                self.allocator.allocate()
+        if target > credited:
+            for index, rate in enumerate(self.rates):
+                amounts[index] += rate*(target - credited)
+        self.turn = target
+        if self.allocator is not None and self.allocator.waiting:
+            self.allocator.allocate()
+
+    def settle(self):
+        """
+        Bring the state of every building up to date with the current turn,
+        eg before saving
+        :return:
+        """
+        for building in self.cell_field.buildings:
+            building.settle(self.turn)
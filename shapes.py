@@ -0,0 +1,129 @@
+"""
+Shapes of ground blocks.
+Shapes are loaded once from shapes.json, where each shape is a list of rows
+with '#' for a cell and '.' for a gap. Everything needed to generate and
+place a block is computed when a shape is loaded: a list of its cells and
+their offsets from the anchor.
+"""
+
+import json
+import os
+
+from cells import Ground
+
+shapes_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'shapes.json')
+
+
+class Shape:
+    """
+    An immutable shape of a ground block.
+    `rows` is a tuple of tuples of booleans. `cells` are (row, column)
+    positions of the cells in `rows`, and `offsets` are (row, column) offsets
+    of the same cells on the field relative to the block's anchor, as used by
+    CityEngine: the anchor is the middle element and rows go bottom-up.
+    """
+    def __init__(self, rows, name=''):
+        self.name = name
+        self.rows = tuple(tuple(bool(x) for x in row) for row in rows)
+        self.height = len(self.rows)
+        self.width = max(len(row) for row in self.rows)
+        cells = []
+        offsets = []
+        y_midpoint = int(self.height/2)
+        for y, row in enumerate(self.rows):
+            x_midpoint = int(len(row)/2)
+            for x, filled in enumerate(row):
+                if filled:
+                    cells.append((y, x))
+                    offsets.append((y_midpoint - y, x - x_midpoint))
+        self.cells = tuple(cells)
+        self.offsets = tuple(offsets)
+
+    @classmethod
+    def from_strings(cls, strings, name=''):
+        return cls([[x == '#' for x in row] for row in strings], name=name)
+
+    @property
+    def size(self):
+        return self.height, self.width
+
+    def make_block(self, ground_type):
+        """
+        Return a GroundBlock of this shape
+        :param ground_type:
+        :return:
+        """
+        return GroundBlock(self, ground_type)
+
+
+class GroundBlock(list):
+    """
+    A ground block to be placed on the field.
+    It is a nested list of Ground objects (or Nones for gaps), like ground
+    blocks always were, so the widgets can display it as is. The engine uses
+    its `shape` instead of walking the lists.
+    """
+    def __init__(self, shape, ground_type):
+        ground = Ground(ground_type)
+        super(GroundBlock, self).__init__(
+            [ground if x else None for x in row] for row in shape.rows)
+        self.shape = shape
+        self.ground = ground
+
+    @property
+    def ground_type(self):
+        return self.ground.ground_type
+
+
+class ShapeCatalog:
+    """
+    All the shapes from a shapes file, by size
+    """
+    def __init__(self, path=shapes_path):
+        with open(path) as file:
+            data = json.load(file)
+        self.shapes = {}
+        for description in data['shapes']:
+            shape = Shape.from_strings(description['rows'],
+                                       name=description.get('name', ''))
+            self.shapes.setdefault(shape.size, []).append(shape)
+        for size in self.shapes:
+            self.shapes[size] = tuple(self.shapes[size])
+
+    def get_shapes(self, size):
+        """
+        Return a tuple of shapes of a given (height, width)
+        :param size:
+        :return:
+        """
+        return self.shapes.get(tuple(size), ())
+
+    def all_shapes(self):
+        for shapes in self.shapes.values():
+            yield from shapes
+
+
+_catalog = None
+
+
+def get_catalog():
+    """
+    Return the shape catalog, loading it on first call
+    :return:
+    """
+    global _catalog
+    if _catalog is None:
+        _catalog = ShapeCatalog()
+    return _catalog
+
+
+def block_from_rows(rows):
+    """
+    Make a GroundBlock from a nested list of ground type names (or Nones),
+    eg one loaded from a save. Blocks must be made of a single ground type
+    :param rows:
+    :return:
+    """
+    ground_type = next(x for row in rows for x in row if x)
+    return GroundBlock(Shape(rows), ground_type)
@@ -0,0 +1,267 @@
+"""
+Batch simulation for balancing.
+Plays a lot of seeded headless games with random legal moves for every
+combination of parameters in a grid, spread over a process pool. Results of
+each game are appended to a JSON lines file as soon as the game is over, and
+mean resource curves for every combination are written at the end.
+
+Parameters are given as `--param name=value1,value2,...`, where the name is
+either `<item>.<argument>` for an argument of the item's constructor, eg
+`house.growth_threshold=8,10,12` or `smithery.workers_required=1,2`, or
+`weight.<item>` for the relative odds of an item, eg `weight.boat=1,2`.
+Weighted items are the ones the NextItemFactory generates, and items with
+arguments the ones in buildings.json. Names are checked before any game is
+played.
+
+Example:
+    python sweep.py --games 1000 --turns 200 \\
+        --param house.growth_threshold=8,10 --param weight.boat=1,2 \\
+        --output games.jsonl --summary summary.json
+"""
+
+import argparse
+import inspect
+import itertools
+import json
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from bot import play_randomly
+from buildings import building_types
+from cells import StackCityException
+from engine import CityEngine
+from factories import possible_items
+
+
+def parse_value(value):
+    """
+    Turn a parameter value into an int or a float if it looks like one
+    :param value:
+    :return:
+    """
+    for kind in (int, float):
+        try:
+            return kind(value)
+        except ValueError:
+            pass
+    return value
+
+
+def parse_param(param):
+    """
+    Parse a `name=value1,value2` parameter
+    :param param:
+    :return: (name, [values])
+    """
+    name, separator, values = param.partition('=')
+    if not separator or '.' not in name or not values:
+        raise StackCityException(
+            'Parameters are given as item.argument=value1,value2')
+    check_name(name)
+    return name, [parse_value(x) for x in values.split(',')]
+
+
+def check_name(name):
+    """
+    Raise StackCityException unless a parameter name is an argument of a
+    building type or the weight of an item the factory generates
+    :param name:
+    :return:
+    """
+    item, argument = name.split('.', 1)
+    if item == 'weight':
+        if argument not in possible_items:
+            raise StackCityException(
+                'Unknown item {}, expected one of {}'.format(
+                    argument, ', '.join(possible_items)))
+    elif item not in building_types:
+        raise StackCityException(
+            'Unknown building {}, expected one of {}'.format(
+                item, ', '.join(building_types)))
+    elif argument not in constructor_arguments(building_types[item]):
+        raise StackCityException('{} takes no argument {}'.format(
+            item, argument))
+
+
+def constructor_arguments(cls):
+    """
+    Return the names of the keyword arguments a class can be created with
+    :param cls:
+    :return: a set of names
+    """
+    r = set()
+    for klass in cls.__mro__:
+        init = vars(klass).get('__init__')
+        if init is None:
+            continue
+        for name, parameter in inspect.signature(init).parameters.items():
+            if name != 'self' and parameter.kind in (
+                    parameter.POSITIONAL_OR_KEYWORD, parameter.KEYWORD_ONLY):
+                r.add(name)
+    return r
+
+
+def make_grid(params):
+    """
+    Return a list of configurations, one for every combination of values
+    :param params: a list of (name, [values])
+    :return: a list of dicts from parameter names to values
+    """
+    names = [name for name, values in params]
+    return [dict(zip(names, combination)) for combination in
+            itertools.product(*(values for name, values in params))]
+
+
+def engine_arguments(config):
+    """
+    Turn a configuration into CityEngine's item_weights and building_params
+    :param config:
+    :return:
+    """
+    item_weights = {}
+    building_params = {}
+    for name, value in config.items():
+        item, argument = name.split('.', 1)
+        if item == 'weight':
+            item_weights[argument] = value
+        else:
+            building_params.setdefault(item, {})[argument] = value
+    return item_weights or None, building_params
+
+
+def run_game(config, seed, turns, field_size, sample_every):
+    """
+    Play a single game. Runs in a worker process
+    :param config:
+    :param seed:
+    :param turns:
+    :param field_size:
+    :param sample_every: resources are recorded every this many turns
+    :return: a dict with the game results
+    """
+    item_weights, building_params = engine_arguments(config)
+    engine = CityEngine(field_size=field_size, seed=seed,
+                        item_weights=item_weights,
+                        building_params=building_params)
+    engine.start_turn()
+    rng = random.Random(seed)
+    resources = engine.city_state.resources
+    curve = []
+    for x in range(0, turns, sample_every):
+        play_randomly(engine, min(sample_every, turns - x), rng)
+        curve.append(dict(resources))
+    return {'config': config,
+            'seed': seed,
+            'turns': engine.turn,
+            'buildings': len(engine.buildings),
+            'resources': dict(resources),
+            'curve': curve}
+
+
+class CurveAggregate:
+    """
+    Running sums of resource curves of the games of a single configuration
+    """
+    def __init__(self, config):
+        self.config = config
+        self.games = 0
+        #  A list of {resource: sum} per sample
+        self.sums = []
+
+    def add(self, result):
+        self.games += 1
+        for index, sample in enumerate(result['curve']):
+            if index == len(self.sums):
+                self.sums.append(dict.fromkeys(sample, 0))
+            for name, value in sample.items():
+                self.sums[index][name] += value
+
+    def summary(self):
+        """
+        Return the configuration with mean resources per sample
+        :return:
+        """
+        return {'config': self.config,
+                'games': self.games,
+                'mean_curve': [{name: value/self.games
+                                for name, value in sample.items()}
+                               for sample in self.sums]}
+
+
+def run_sweep(grid, games, turns, field_size=18, sample_every=10,
+              processes=None, seed=0, output=None):
+    """
+    Play `games` games for every configuration in the grid.
+    Game results are written to `output` (a text file) as they come in
+    :param grid: a list of configurations, see make_grid
+    :param games:
+    :param turns:
+    :param field_size:
+    :param sample_every:
+    :param processes: pool size, os.cpu_count() if None
+    :param seed: games are seeded with seed, seed+1 and so on. Every
+    configuration gets the same seeds
+    :param output:
+    :return: a list of CurveAggregate summaries, in grid order
+    """
+    aggregates = [CurveAggregate(config) for config in grid]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {}
+        for index, config in enumerate(grid):
+            for game in range(games):
+                future = pool.submit(run_game, config, seed + game, turns,
+                                     field_size, sample_every)
+                futures[future] = index
+        for future in as_completed(futures):
+            result = future.result()
+            aggregates[futures[future]].add(result)
+            if output is not None:
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+    return [x.summary() for x in aggregates]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run a balancing sweep of headless StackCity games')
+    parser.add_argument('--games', type=int, default=100,
+                        help='games per configuration')
+    parser.add_argument('--turns', type=int, default=200)
+    parser.add_argument('--field-size', type=int, default=18)
+    parser.add_argument('--sample-every', type=int, default=10,
+                        help='record resources every this many turns')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--param', action='append', default=[],
+                        help='item.argument=value1,value2 or '
+                             'weight.item=value1,value2')
+    parser.add_argument('--output', default='sweep.jsonl',
+                        help='per-game results, one JSON object a line')
+    parser.add_argument('--summary', default='sweep_summary.json',
+                        help='mean resource curves per configuration')
+    args = parser.parse_args(argv)
+    try:
+        grid = make_grid([parse_param(x) for x in args.param])
+    except StackCityException as e:
+        parser.error(str(e))
+    start = time.monotonic()
+    with open(args.output, 'w') as output:
+        summaries = run_sweep(grid, args.games, args.turns,
+                              field_size=args.field_size,
+                              sample_every=args.sample_every,
+                              processes=args.processes, seed=args.seed,
+                              output=output)
+    with open(args.summary, 'w') as file:
+        json.dump(summaries, file, indent=1)
+    print('{} games in {:.1f} s'.format(len(grid)*args.games,
+                                         time.monotonic() - start),
+          file=sys.stderr)
+    for summary in summaries:
+        final = summary['mean_curve'][-1] if summary['mean_curve'] else {}
+        print(json.dumps(summary['config']), json.dumps(final))
+
+
+if __name__ == '__main__':
+    main()
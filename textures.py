@@ -0,0 +1,67 @@
+"""
+All the game's sprites as Kivy textures, resolved once.
+Ground tiles, buildings and resource icons are packed into a single atlas,
+sprites.atlas, by build_atlas.py. Every region of it is turned into a
+Texture when the cache is created, so widgets can swap textures directly
+instead of resolving `atlas://` and file name sources over and over, and
+everything drawn from the atlas shares one GL texture.
+If sprites.atlas hasn't been built, ground tiles come from grounds.atlas and
+other sprites are loaded from their own files on first use.
+"""
+
+import os
+
+from kivy.atlas import Atlas
+from kivy.core.image import Image as CoreImage
+
+base_path = os.path.dirname(os.path.abspath(__file__))
+sprites_path = os.path.join(base_path, 'sprites.atlas')
+grounds_path = os.path.join(base_path, 'grounds.atlas')
+
+
+def sprite_key(source):
+    """
+    Return the atlas key of an image file, eg 'House' for 'House.png'
+    :param source:
+    :return:
+    """
+    return os.path.splitext(os.path.basename(source))[0]
+
+
+class TextureCache:
+    """
+    Textures by atlas key
+    """
+    def __init__(self, path=sprites_path, fallback_path=grounds_path):
+        self.atlas = Atlas(path if os.path.exists(path) else fallback_path)
+        self.textures = dict(self.atlas.textures)
+
+    def get(self, key):
+        """
+        Return a texture by atlas key or by image file name
+        :param key:
+        :return:
+        """
+        texture = self.textures.get(key)
+        if texture is None:
+            texture = self.textures.get(sprite_key(key))
+            if texture is None:
+                #  Not in the atlas, so loaded from its own file, once
+                texture = CoreImage(os.path.join(base_path, key)).texture
+            self.textures[key] = texture
+        return texture
+
+
+_cache = None
+
+
+def get_cache():
+    """
+    Return the texture cache, creating it on first call. It needs a GL
+    context, so it can't be created before the app has started
+    :return:
+    """
+    global _cache
+    if _cache is None:
+        _cache = TextureCache()
+    return _cache
@@ -0,0 +1,130 @@
+"""
+Autotiling: choosing a tile from grounds.atlas for each cell based on its
+neighbours.
+For a bordered cell (currently only water), the first non-empty foreign
+ground among the upper, left, right and lower neighbours (in this order) is
+the one a border is drawn with. The cells of that ground around the query
+cell make an 8-bit mask, and a precomputed table maps the mask to atlas key.
+"""
+
+from cells import ground_type_list, ground_codes
+
+#  Neighbour bits, ordered like in CellField.get_neighbours
+UPPER_LEFT, UPPER, UPPER_RIGHT, LEFT, RIGHT, LOWER_LEFT, LOWER, LOWER_RIGHT = \
+    (1 << x for x in range(8))
+
+#  Grounds that get borders drawn on them
+bordered_grounds = {ground_codes['water']}
+
+
+def _border_postfix(mask):
+    """
+    Return a border tile number for a neighbour mask, or None if no border is
+    needed.
+    No more than 2 borders per cell are supported. This is mostly due to there
+    being no 3-walled or 4-walled tiles and is to be fixed sometime later. In
+    addition, border choice is dependent on position of neighbours: upper
+    takes precedence over lower and left -- over right. Corners are not used
+    yet, although they are a part of the mask
+    :param mask:
+    :return:
+    """
+    if mask & UPPER:
+        if mask & LEFT:
+            return 7
+        elif mask & RIGHT:
+            return 9
+        return 8
+    elif mask & LEFT:
+        return 1 if mask & LOWER else 4
+    elif mask & RIGHT:
+        return 3 if mask & LOWER else 6
+    elif mask & LOWER:
+        return 2
+    return None
+
+
+def _make_key_table():
+    """
+    Build a table of atlas keys: table[own_code][foreign_code][mask]
+    :return:
+    """
+    table = []
+    for own in ground_type_list:
+        own_row = []
+        for foreign in ground_type_list:
+            keys = []
+            for mask in range(256):
+                postfix = _border_postfix(mask)
+                if postfix is None:
+                    keys.append(own)
+                else:
+                    keys.append('{0}_{1}_{2}'.format(own, foreign, postfix))
+            own_row.append(tuple(keys))
+        table.append(tuple(own_row))
+    return tuple(table)
+
+
+key_table = _make_key_table()
+_empty = ground_codes['empty']
+
+
+def tile_key(cell_field, number):
+    """
+    Return an atlas key for cell #number of a given CellField
+    :param cell_field:
+    :param number:
+    :return:
+    """
+    grounds = cell_field.grounds
+    own = grounds[number]
+    if own not in bordered_grounds:
+        return ground_type_list[own]
+    table = cell_field.neighbour_table
+    base = number*8
+    foreign = None
+    #  Upper, left, right and lower neighbours
+    for index in (1, 3, 4, 6):
+        neighbour = table[base+index]
+        if neighbour >= 0 and grounds[neighbour] not in (_empty, own):
+            foreign = grounds[neighbour]
+            break
+    if foreign is None:
+        return ground_type_list[own]
+    mask = 0
+    for index in range(8):
+        neighbour = table[base+index]
+        if neighbour >= 0 and grounds[neighbour] == foreign:
+            mask |= 1 << index
+    return key_table[own][foreign][mask]
+
+
+class TileResolver:
+    """
+    A set of cells whose tiles may have changed.
+    Changed cells are marked dirty together with their neighbours, and then
+    all of them are resolved at once.
+    """
+    def __init__(self, cell_field):
+        self.cell_field = cell_field
+        self.dirty = set()
+
+    def mark_dirty(self, numbers):
+        """
+        Remember that cells `numbers` have changed. Their neighbours, whose
+        borders may depend on them, are marked dirty as well
+        :param numbers:
+        :return:
+        """
+        self.dirty.update(numbers)
+        self.dirty.update(self.cell_field.get_neighbourhood(numbers))
+
+    def resolve(self):
+        """
+        Compute atlas keys for all dirty cells and clean them
+        :return: a dict of {cell number: atlas key}
+        """
+        r = {number: tile_key(self.cell_field, number)
+             for number in self.dirty}
+        self.dirty.clear()
+        return r
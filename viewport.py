@@ -0,0 +1,138 @@
+"""
+The visible part of the field.
+All coordinates here are in pixels, relative to the upper left corner of the
+field widget, with y growing downwards, the same way cell rows do. Widgets
+are expected to convert Kivy's coordinates themselves.
+"""
+
+
+class Viewport:
+    """
+    A window into a field that can be panned and zoomed.
+    It knows which cells are visible and where they should be drawn, so that
+    the field widgets only deal with what's on screen.
+    """
+    min_zoom = 0.25
+    max_zoom = 4.0
+
+    def __init__(self, field_size, cell_size=32, margin=2):
+        self.field_size = field_size
+        #  Cell side at zoom 1, in pixels
+        self.cell_size = cell_size
+        #  How many cells beyond the screen edges are considered visible
+        self.margin = margin
+        self.zoom = 1.0
+        #  Field coordinates of the upper left corner of the view
+        self.offset_x = 0.0
+        self.offset_y = 0.0
+        self.width = 0
+        self.height = 0
+
+    @property
+    def scaled_cell_size(self):
+        return self.cell_size*self.zoom
+
+    @property
+    def field_extent(self):
+        """
+        Field side in pixels at the current zoom
+        :return:
+        """
+        return self.field_size*self.scaled_cell_size
+
+    def resize(self, width, height):
+        self.width = width
+        self.height = height
+        self.clamp()
+
+    def clamp(self):
+        """
+        Keep the view from wandering off the field
+        :return:
+        """
+        self.offset_x = min(max(self.offset_x, 0),
+                            max(0, self.field_extent - self.width))
+        self.offset_y = min(max(self.offset_y, 0),
+                            max(0, self.field_extent - self.height))
+
+    def pan(self, dx, dy):
+        """
+        Move the field by (dx, dy) pixels. Positive dy moves it down
+        :param dx:
+        :param dy:
+        :return:
+        """
+        self.offset_x -= dx
+        self.offset_y -= dy
+        self.clamp()
+
+    def zoom_at(self, factor, x, y):
+        """
+        Multiply zoom by `factor`, keeping the field point under (x, y) in
+        place
+        :param factor:
+        :param x:
+        :param y:
+        :return:
+        """
+        zoom = min(max(self.zoom*factor, self.min_zoom), self.max_zoom)
+        field_x = (x + self.offset_x)/self.zoom
+        field_y = (y + self.offset_y)/self.zoom
+        self.zoom = zoom
+        self.offset_x = field_x*zoom - x
+        self.offset_y = field_y*zoom - y
+        self.clamp()
+
+    def visible_range(self):
+        """
+        Return (first_row, last_row, first_col, last_col) of visible cells,
+        margin included. Last row and column are exclusive
+        :return:
+        """
+        size = self.scaled_cell_size
+        first_row = max(0, int(self.offset_y // size) - self.margin)
+        first_col = max(0, int(self.offset_x // size) - self.margin)
+        last_row = min(self.field_size,
+                       int((self.offset_y + self.height) // size) +
+                       1 + self.margin)
+        last_col = min(self.field_size,
+                       int((self.offset_x + self.width) // size) +
+                       1 + self.margin)
+        return first_row, last_row, first_col, last_col
+
+    def visible_cells(self):
+        """
+        Yield numbers of all visible cells, row by row
+        :return:
+        """
+        first_row, last_row, first_col, last_col = self.visible_range()
+        for row in range(first_row, last_row):
+            yield from range(row*self.field_size + first_col,
+                             row*self.field_size + last_col)
+
+    def cell_at(self, x, y):
+        """
+        Return the number of a cell at (x, y), or None if there is no cell
+        there
+        :param x:
+        :param y:
+        :return:
+        """
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        size = self.scaled_cell_size
+        col = int((x + self.offset_x) // size)
+        row = int((y + self.offset_y) // size)
+        if 0 <= col < self.field_size and 0 <= row < self.field_size:
+            return row*self.field_size + col
+        return None
+
+    def cell_origin(self, number):
+        """
+        Return the position of the upper left corner of cell #number
+        :param number:
+        :return:
+        """
+        row, col = divmod(number, self.field_size)
+        size = self.scaled_cell_size
+        return col*size - self.offset_x, row*size - self.offset_y
@@ -0,0 +1,66 @@
+"""
+Assigning workers to workshops.
+The city's 'workforce' resource is the pool of free workers. Workshops that
+are short of workers wait in a priority queue, earliest placed first, and
+get workers from the pool whenever there are any: right after placement and
+whenever the pool grows. Workshops never give workers back, so the queue
+only ever changes when a workshop is placed or the pool grows, and a fully
+staffed workshop costs nothing.
+"""
+
+import heapq
+
+from buildings import Workshop
+from city import resource_index
+
+WORKFORCE = resource_index['workforce']
+
+
+class WorkforceAllocator:
+    """
+    Workers of a CellField's workshops
+    """
+    def __init__(self, cell_field, on_change=None):
+        self.cell_field = cell_field
+        #  Called with a workshop whose workers have changed, except for
+        #  the one being added
+        self.on_change = on_change
+        #  building_ids of understaffed workshops
+        self.waiting = []
+        for building in cell_field.buildings:
+            if isinstance(building, Workshop) and \
+                    building.workers < building.workers_required:
+                self.waiting.append(building.building_id)
+        heapq.heapify(self.waiting)
+        self.allocate()
+
+    def add(self, building):
+        """
+        Staff a building that has just been placed, if it needs workers
+        :param building:
+        :return:
+        """
+        if isinstance(building, Workshop) and \
+                building.workers < building.workers_required:
+            heapq.heappush(self.waiting, building.building_id)
+            self.allocate(placed=building)
+
+    def allocate(self, placed=None):
+        """
+        Give free workers to waiting workshops, earliest placed first
+        :param placed: a building being placed, which isn't scheduled yet
+        and so needs no on_change call
+        :return:
+        """
+        amounts = self.cell_field.city_state.resources.amounts
+        buildings = self.cell_field.buildings
+        while self.waiting and amounts[WORKFORCE] > 0:
+            building = buildings[self.waiting[0]]
+            workers = min(building.workers_required - building.workers,
+                          amounts[WORKFORCE])
+            amounts[WORKFORCE] -= workers
+            building.workers += workers
+            if building.workers >= building.workers_required:
+                heapq.heappop(self.waiting)
+            if self.on_change is not None and building is not placed:
+                self.on_change(building)